@@ -1,10 +1,20 @@
 import numpy
 cimport numpy
-from numpy import *
+cimport cython
+from cython.parallel cimport prange
+from libc cimport math as cmath
+# a star import of numpy clashes with the array type used by memoryviews
+from numpy import (sin, cos, arcsin, sqrt, abs, pi, zeros, asarray, allclose, random,
+                   intp, argsort, log10, floor, diff, flatnonzero, concatenate)
 import numexpr
+from scipy.spatial import cKDTree
+import scipy.sparse
+from multiprocessing import cpu_count
 
 pscale = 1.0
 sscale = 1.0
+nthreads = cpu_count()  # OpenMP threads used by the distance kernels
+npairs = 0  # pairs of markings compared by the distance kernels in this process
 lunar_radius = 1737.4*1000  # metres
 cdef float lunar_diameter = 2 * lunar_radius
 
@@ -14,36 +24,110 @@ DTYPE = numpy.double
 ctypedef numpy.double_t DTYPE_t
 
 def test(n=100):
-    from scipy.spatial.distance import pdist, cdist
     from timethis import timethis
     x = random.normal(10, 1, (n, 4))
     y = random.normal(10, 1, (n, 4))
     x[:,3] = x[:,3] > 11.0
     y[:,3] = y[:,3] > 11.0
     d1 = crater_pdist(x)
-    d2 = pdist(x, crater_metric_one)
-    if (d1 == d2).all():
+    d2 = crater_pdist_orig(x)
+    if allclose(d1, d2, rtol=1e-12, atol=0):
         print 'pdist match'
     else:
         print 'pdist do not match'
         return x, y, d1, d2
-    t1 = timethis('crater_pdist(x)', globals(), locals())
-    t2 = timethis('pdist(x, crater_metric_one)', globals(), locals())
+    t1 = timethis('crater_pdist(x)', globals(), locals(), wall=True)
+    t2 = timethis('crater_pdist_orig(x)', globals(), locals(), wall=True)
     f = t1/t2
     print 'New pdist runs in a factor of %.3f of the time of the original'%f
     d1 = crater_cdist(x, y)
-    d2 = cdist(x, y, crater_metric_one)
-    if (d1 == d2).all():
+    d2 = crater_cdist_orig(x, y)
+    if allclose(d1, d2, rtol=1e-12, atol=0):
         print 'cdist match'
     else:
         print 'cdist do not match'
         return x, y, d1, d2
-    t1 = timethis('crater_cdist(x, y)', globals(), locals())
-    t2 = timethis('cdist(x, y, crater_metric_one)', globals(), locals())
+    t1 = timethis('crater_cdist(x, y)', globals(), locals(), wall=True)
+    t2 = timethis('crater_cdist_orig(x, y)', globals(), locals(), wall=True)
     f = t1/t2
     print 'New cdist runs in a factor of %.3f of the time of the original'%f
-    
-def crater_pdist(numpy.ndarray[DTYPE_t, ndim=2] X):
+    print '(using %i threads)'%nthreads
+
+cdef inline double crater_distance(double long1, double lat1, double coslat1, double s1, double m1,
+                                   double long2, double lat2, double coslat2, double s2, double m2,
+                                   double ps, double ss) nogil:
+    # crater_metric for a single pair, without any temporary arrays,
+    # given the cosines of the latitudes, which are calculated once per row
+    cdef double sm, ds, hdLat, hdLong, sinLat, sinLong, x, dr
+    # calculate crater size difference
+    sm = (s1 + s2)/2.0
+    ds = (1-m1) * (1-m2) * cmath.fabs(s1 - s2) / sm
+    # calculate crater position difference
+    hdLat = (lat2 - lat1)/2.0
+    hdLong = (long2 - long1)/2.0
+    sinLat = cmath.sin(hdLat)
+    sinLong = cmath.sin(hdLong)
+    x = sinLat*sinLat + sinLong*sinLong * coslat1 * coslat2
+    dr = lunar_diameter * cmath.asin(cmath.sqrt(x)) / sm
+    # combine position and size differences
+    dr /= ps
+    ds /= ss
+    return cmath.sqrt(dr*dr + ds*ds)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def crater_pdist(double[:, :] X, int num_threads=0):
+    """ Condensed matrix of crater_metric distances between the rows of X,
+        as scipy.spatial.distance.pdist.  Rows are shared between
+        num_threads OpenMP threads, by default crater_metrics.nthreads.
+    """
+    cdef double[:] dm, coslat
+    cdef Py_ssize_t m, i, j, k
+    cdef double ps = pscale, ss = sscale
+    global npairs
+    if num_threads <= 0:
+        num_threads = nthreads
+    m = X.shape[0]
+    npairs += (m * (m - 1)) // 2
+    coslat = cos(X[:,1])
+    result = zeros((m * (m - 1)) // 2, dtype=DTYPE)
+    dm = result
+    for i in prange(m-1, nogil=True, schedule='dynamic', num_threads=num_threads):
+        k = i*m - (i*(i+1))//2
+        for j in range(i+1, m):
+            dm[k+j-i-1] = crater_distance(X[i,0], X[i,1], coslat[i], X[i,2], X[i,3],
+                                          X[j,0], X[j,1], coslat[j], X[j,2], X[j,3], ps, ss)
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def crater_cdist(double[:, :] X1, double[:, :] X2, int num_threads=0):
+    """ Matrix of crater_metric distances between the rows of X1 and X2,
+        as scipy.spatial.distance.cdist.  Rows are shared between
+        num_threads OpenMP threads, by default crater_metrics.nthreads.
+    """
+    cdef double[:, :] dm
+    cdef double[:] coslat1, coslat2
+    cdef Py_ssize_t m, n, i, j
+    cdef double ps = pscale, ss = sscale
+    global npairs
+    if num_threads <= 0:
+        num_threads = nthreads
+    m = X1.shape[0]
+    n = X2.shape[0]
+    npairs += m * n
+    coslat1 = cos(X1[:,1])
+    coslat2 = cos(X2[:,1])
+    result = zeros((m, n), dtype=DTYPE)
+    dm = result
+    for i in prange(m, nogil=True, schedule='static', num_threads=num_threads):
+        for j in range(n):
+            dm[i,j] = crater_distance(X1[i,0], X1[i,1], coslat1[i], X1[i,2], X1[i,3],
+                                      X2[j,0], X2[j,1], coslat2[j], X2[j,2], X2[j,3], ps, ss)
+    return result
+
+def crater_pdist_orig(numpy.ndarray[DTYPE_t, ndim=2] X):
+    # original row-by-row implementation, kept for testing
     cdef numpy.ndarray[DTYPE_t, ndim=1] x, dm
     cdef int m, i, k
     m = X.shape[0]
@@ -55,7 +139,8 @@ def crater_pdist(numpy.ndarray[DTYPE_t, ndim=2] X):
         k += m-i-1
     return dm
 
-def crater_cdist(numpy.ndarray[DTYPE_t, ndim=2] X1, numpy.ndarray[DTYPE_t, ndim=2] X2):
+def crater_cdist_orig(numpy.ndarray[DTYPE_t, ndim=2] X1, numpy.ndarray[DTYPE_t, ndim=2] X2):
+    # original row-by-row implementation, kept for testing
     cdef numpy.ndarray[DTYPE_t, ndim=1] x
     cdef numpy.ndarray[DTYPE_t, ndim=2] dm
     cdef int m, n, i, k
@@ -94,6 +179,228 @@ cpdef numpy.ndarray[DTYPE_t, ndim=1] crater_metric(numpy.ndarray[DTYPE_t, ndim=1
     dist = sqrt(dr**2 + ds**2)
     return dist
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def crater_pair_metric(double[:, :] X, i, j, int num_threads=0):
+    """ crater_metric evaluated only for the index pairs (i[k], j[k]) """
+    cdef Py_ssize_t[:] ii, jj
+    cdef double[:] dist, coslat
+    cdef Py_ssize_t k, a, b, n
+    cdef double ps = pscale, ss = sscale
+    global npairs
+    if num_threads <= 0:
+        num_threads = nthreads
+    coslat = cos(X[:,1])
+    ii = asarray(i, dtype=intp)
+    jj = asarray(j, dtype=intp)
+    n = ii.shape[0]
+    npairs += n
+    result = zeros(n, dtype=DTYPE)
+    dist = result
+    for k in prange(n, nogil=True, schedule='static', num_threads=num_threads):
+        a = ii[k]
+        b = jj[k]
+        dist[k] = crater_distance(X[a,0], X[a,1], coslat[a], X[a,2], X[a,3],
+                                  X[b,0], X[b,1], coslat[b], X[b,2], X[b,3], ps, ss)
+    return result
+
+def crater_pair_components(numpy.ndarray[DTYPE_t, ndim=2] X1, numpy.ndarray[DTYPE_t, ndim=2] X2):
+    # absolute position, position and size differences between
+    # corresponding rows of X1 and X2, as crater_absolute_position_metric,
+    # crater_position_metric and crater_size_metric
+    cdef numpy.ndarray[DTYPE_t, ndim=1] long1, lat1, s1, m1, long2, lat2, s2, m2
+    cdef numpy.ndarray[DTYPE_t, ndim=1] sm, neither_minsize, ds, hdLat, hdLong, x, dra, drs
+    # get coords
+    long1, lat1, s1, m1 = X1[:,:4].T
+    long2, lat2, s2, m2 = X2[:,:4].T
+    # calculate crater size difference
+    sm = (s1 + s2)/2.0
+    neither_minsize = (1-m1) * (1-m2)
+    ds = neither_minsize * abs(s1 - s2) / sm
+    # calculate crater position difference
+    hdLat = (lat2 - lat1)/2.0
+    hdLong = (long2 - long1)/2.0
+    x = sin(hdLat)**2 + sin(hdLong)**2 * cos(lat1) * cos(lat2)
+    dra = lunar_diameter * arcsin(sqrt(x))
+    drs = dra / sm
+    return dra, drs, ds
+
+def crater_unit_vectors(numpy.ndarray[DTYPE_t, ndim=2] X):
+    # positions on the unit sphere, so euclidean trees can be used
+    cdef numpy.ndarray[DTYPE_t, ndim=1] long1, lat1
+    long1, lat1 = X[:,0], X[:,1]
+    return numpy.column_stack((cos(lat1)*cos(long1), cos(lat1)*sin(long1), sin(lat1)))
+
+def crater_search_chord(s, double t):
+    # Two markings can only be within crater_metric t of each other if their
+    # separation is less than t*pscale times their mean radius, which is no
+    # more than the larger radius.  Convert that to a chord on the unit sphere.
+    theta = numpy.minimum(t * pscale * numpy.asarray(s, dtype=DTYPE) / lunar_radius, pi)
+    return 2.0 * sin(theta/2.0) * (1 + 1e-9) + 1e-15
+
+def crater_neighbour_pairs(numpy.ndarray[DTYPE_t, ndim=2] X, double t, double bandwidth=0.05):
+    """ Find all pairs of markings with crater_metric <= t.
+
+        Candidates are found with a KD-tree on unit sphere coordinates.
+        Markings are processed in bands of log10(radius) of the given
+        width, each searching with the radius appropriate to its largest
+        member, and each pair is only kept from its larger member.
+        Returns: i, j, dist -- arrays of pair indices and metric distances
+    """
+    cdef numpy.ndarray[DTYPE_t, ndim=1] s, logs, dist
+    cdef numpy.ndarray[numpy.int_t, ndim=1] order, bands, edges, members
+    m = X.shape[0]
+    if m < 2:
+        return zeros(0, int), zeros(0, int), zeros(0, DTYPE)
+    tree = cKDTree(crater_unit_vectors(X))
+    s = X[:,2].copy()
+    order = argsort(s, kind='mergesort').astype(int)
+    logs = log10(s[order])
+    bands = floor((logs - logs[0]) / bandwidth).astype(int)
+    edges = concatenate(([0], flatnonzero(diff(bands)) + 1, [m])).astype(int)
+    pi_list, pj_list = [], []
+    for k in xrange(len(edges) - 1):
+        members = order[edges[k]:edges[k+1]]
+        r = crater_search_chord(s[members].max(), t)
+        band = cKDTree(tree.data[members])
+        neighbours = band.sparse_distance_matrix(tree, r, output_type='ndarray')
+        i = members[neighbours['i']]
+        j = neighbours['j'].astype(int)
+        # each pair is kept only once, from its larger (or lower index) member
+        keep = (s[j] < s[i]) | ((s[j] == s[i]) & (j > i))
+        pi_list.append(i[keep])
+        pj_list.append(j[keep])
+    i = concatenate(pi_list)
+    j = concatenate(pj_list)
+    dist = crater_pair_metric(X, i, j)
+    keep = dist <= t
+    return i[keep], j[keep], dist[keep]
+
+def crater_neighbour_pairs_of(numpy.ndarray[DTYPE_t, ndim=2] X, idx, double t, double bandwidth=0.05):
+    """ Find all pairs of markings with crater_metric <= t which include
+        at least one of the markings idx.
+
+        Bands of log10(radius) are used as in crater_neighbour_pairs, but
+        each band is only searched against the markings idx, and the
+        markings idx in the band against all markings, so the number of
+        pairs compared grows with the size of idx, not of X.
+        Returns: i, j, dist -- arrays of pair indices and metric distances
+    """
+    cdef numpy.ndarray[DTYPE_t, ndim=1] s, logs, dist
+    cdef numpy.ndarray[numpy.int_t, ndim=1] order, bands, edges, members
+    m = X.shape[0]
+    idx = numpy.unique(numpy.asarray(idx, dtype=int))
+    if m < 2 or len(idx) == 0:
+        return zeros(0, int), zeros(0, int), zeros(0, DTYPE)
+    tree = cKDTree(crater_unit_vectors(X))
+    target = cKDTree(tree.data[idx])
+    selected = zeros(m, dtype=bool)
+    selected[idx] = True
+    s = X[:,2].copy()
+    order = argsort(s, kind='mergesort').astype(int)
+    logs = log10(s[order])
+    bands = floor((logs - logs[0]) / bandwidth).astype(int)
+    edges = concatenate(([0], flatnonzero(diff(bands)) + 1, [m])).astype(int)
+    pi_list, pj_list = [], []
+    for k in xrange(len(edges) - 1):
+        members = order[edges[k]:edges[k+1]]
+        r = crater_search_chord(s[members].max(), t)
+        # pairs whose smaller member is in idx
+        band = cKDTree(tree.data[members])
+        neighbours = band.sparse_distance_matrix(target, r, output_type='ndarray')
+        pi_list.append(members[neighbours['i']])
+        pj_list.append(idx[neighbours['j']])
+        # pairs whose larger member is in idx and smaller is not
+        members = members[selected[members]]
+        if len(members) > 0:
+            band = cKDTree(tree.data[members])
+            neighbours = band.sparse_distance_matrix(tree, r, output_type='ndarray')
+            j = neighbours['j'].astype(int)
+            pi_list.append(members[neighbours['i']][~selected[j]])
+            pj_list.append(j[~selected[j]])
+    i = concatenate(pi_list)
+    j = concatenate(pj_list)
+    # each pair is kept only once, from its larger (or lower index) member
+    keep = (s[j] < s[i]) | ((s[j] == s[i]) & (j > i))
+    i, j = i[keep], j[keep]
+    dist = crater_pair_metric(X, i, j)
+    keep = dist <= t
+    return i[keep], j[keep], dist[keep]
+
+def crater_graph(m, i, j, dist):
+    """ Upper triangular sparse graph of the distances between pairs of
+        markings.  Distances of zero are stored as the smallest positive
+        double, so they are not mistaken for missing pairs.
+    """
+    lo = numpy.minimum(i, j)
+    hi = numpy.maximum(i, j)
+    dist = numpy.maximum(dist, numpy.finfo(DTYPE).tiny)
+    return scipy.sparse.coo_matrix((dist, (lo, hi)), shape=(m, m)).tocsr()
+
+def crater_neighbour_graph(numpy.ndarray[DTYPE_t, ndim=2] X, double t):
+    # sparse graph of all pairs with crater_metric <= t, via crater_neighbour_pairs
+    i, j, dist = crater_neighbour_pairs(X, t)
+    return crater_graph(X.shape[0], i, j, dist)
+
+def crater_nearest(tree, numpy.ndarray[DTYPE_t, ndim=2] X1, numpy.ndarray[DTYPE_t, ndim=2] X2, int k=8):
+    """ crater_metric distance from each row of X2 to its nearest row of X1.
+
+        tree is a cKDTree of crater_unit_vectors(X1), so it can be kept
+        while X2 changes.  The k nearest rows of X1 in position are
+        compared first.  Any row of X2 for which a further row of X1
+        could still be nearer, given the largest radius in X1, is
+        compared again with four times as many, until none remain.
+    """
+    n1 = X1.shape[0]
+    n2 = X2.shape[0]
+    X = numpy.ascontiguousarray(concatenate((X1, X2)), dtype=DTYPE)
+    u = crater_unit_vectors(X2)
+    smax = X1[:,2].max()
+    nearest = zeros(n2, dtype=DTYPE)
+    todo = numpy.arange(n2)
+    while len(todo) > 0:
+        k = min(k, n1)
+        chord, j = tree.query(u[todo], k)
+        chord = chord.reshape(len(todo), k)
+        j = j.reshape(len(todo), k)
+        i = numpy.repeat(todo + n1, k)
+        d = crater_pair_metric(X, j.ravel(), i).reshape(len(todo), k)
+        nearest[todo] = d.min(1)
+        if k == n1:
+            break
+        # lower limit on the position term for rows beyond the k nearest
+        limit = lunar_diameter * arcsin(numpy.minimum(chord[:,-1] / 2.0, 1.0))
+        limit /= (X2[todo,2] + smax) / 2.0 * pscale
+        todo = todo[limit * (1 - 1e-6) < nearest[todo]]
+        k *= 4
+    return nearest
+
+def crater_pdist_sparse(X, double cutoff, int blocksize=1024, int num_threads=0):
+    """ crater_pdist keeping only the distances <= cutoff, as a sparse graph.
+
+        Distances are computed in square blocks of blocksize rows and
+        columns, so memory use is set by the block size and the number
+        of pairs kept, rather than by m*(m-1)/2.
+    """
+    X = numpy.ascontiguousarray(X, dtype=DTYPE)
+    m = X.shape[0]
+    rows, cols, data = [], [], []
+    for a in xrange(0, m, blocksize):
+        b = min(a + blocksize, m)
+        for c in xrange(a, m, blocksize):
+            d = min(c + blocksize, m)
+            D = crater_cdist(X[a:b], X[c:d], num_threads)
+            keep = D <= cutoff
+            if c == a:
+                keep &= numpy.arange(b-a)[:,None] < numpy.arange(d-c)
+            i, j = numpy.nonzero(keep)
+            rows.append(i + a)
+            cols.append(j + c)
+            data.append(D[i, j])
+    if m == 0:
+        return crater_graph(m, zeros(0, int), zeros(0, int), zeros(0, DTYPE))
+    return crater_graph(m, concatenate(rows), concatenate(cols), concatenate(data))
+
 def crater_numexpr_metric(uin, vin):
     # this is not used as does not deliver any speed up over standard numpy
     # get coords
@@ -1,28 +1,28 @@
 import sys, getopt
 import numpy
 import mz_cluster
+import crater_metrics
+from mz_catalogue import read_crater_cat, write_cat
 
-from IPython import embed
 
 def find_cat_offset(cat1, cat2, outcat=None, position_scale=4.0, size_scale=0.4):
+    # Catalogues may be csv files or binary .npy catalogues,
+    # and the output is written in the format given by its extension
     # set global variables for crater metric
-    mz_cluster.pscale = position_scale
-    mz_cluster.sscale = size_scale
-    p1 = numpy.genfromtxt(cat1, delimiter=',', names=True)
-    p2 = numpy.genfromtxt(cat2, delimiter=',', names=True)
+    crater_metrics.pscale = position_scale
+    crater_metrics.sscale = size_scale
+    p1 = read_crater_cat(cat1)
+    p2 = read_crater_cat(cat2)
     offset = mz_cluster.find_offset(p1, p2)
-    p2new = apply_offset(crater_mean, offset)
-    # Write offset crater catalogue to a csv file
+    p2new = mz_cluster.apply_offset(p2, offset)
+    # Write offset crater catalogue
     if outcat is None:
         dot = cat2.rfind('.')
         if dot == -1:
             outcat = cat2+'_offset'
         else:
             outcat = cat2[:dot]+'_offset'+ cat2[dot:]
-    fout = open(outcat, 'w')
-    fout.write(','.join(p2new.dtype.names)+'\n')
-    numpy.savetxt(fout, p2new.T, delimiter=", ", fmt='%.6f')
-    fout.close()
+    write_cat(outcat, p2new)
 
 
 class Usage(Exception):
@@ -39,7 +39,7 @@ def main(argv=None):
         except getopt.error, msg:
             raise Usage(msg)
         if len(args) not in (2, 3):
-            raise Usage("Requires two csv catalogue filenames and an optional output catalogue name.")
+            raise Usage("Requires two catalogue filenames and an optional output catalogue name.")
         else:
             find_cat_offset(*args)
     except Usage, err:
@@ -14,7 +14,8 @@
     This program uses the ISIS routine 'campt' to convert the input
     latitude, longitude and size in metres into pixel coordinates and sizes.
     
-    The crater_csv file is expected to contain the output of mz_cluster.py.
+    The crater_csv file is expected to contain the output of mz_cluster.py,
+    either as a csv file or as a binary .npy catalogue.
     
     The product is another csv file, containing the line, sample and
     radius in pixels for each entry.
@@ -28,6 +29,7 @@ from string import strip
 import numpy
 import tempfile
 from multiprocessing import Pool
+from mz_catalogue import read_crater_cat
 
 # This could be made substantially faster by creating some c++ code based on
 # campt.cpp to read a list of line,sample and output a list of long,lat.
@@ -38,8 +40,9 @@ def latlong2pix(crater_csv=None, output_csv=None, cub_file=None):
     out = file(output_csv, 'w')
     out.write('x_pix, y_pix, radius_pix, axialratio, angle, boulderyness\n')
     # Open input file
-    data = numpy.recfromtxt(crater_csv, delimiter=',', names=True)
-    long,long_err,lat,lat_err,radius,radius_err,axialratio,axialratio_err,angle,angle_err,boulderyness,boulderyness_err = (data.field(n) for n in data.dtype.names)
+    data = read_crater_cat(crater_csv)
+    long, lat, radius, axialratio, angle, boulderyness = (data[n] for n in ('long', 'lat', 'radius', 'axialratio',
+                                                                             'angle', 'boulderyness'))
     # Use multiprocessing to speed things up
     p = Pool(8)
     result = p.map(run_campt_backwards, ((cub_file, long[i], lat[i]) for i in range(len(long))))
@@ -1,13 +1,46 @@
 import numpy
 cimport numpy
 
-DTYPE = numpy.int
-ctypedef numpy.int_t DTYPE_t
+DTYPE = numpy.int64
+ctypedef numpy.int64_t DTYPE_t
 
-def matchids(numpy.ndarray[DTYPE_t, ndim=1] id1, numpy.ndarray[DTYPE_t, ndim=1] id2):
-    """ Match two sets of ids. 
-        Returns: 
-          ibest -- array of indices of i1 that match i2; -1 if no match
+def matchids(id1, id2):
+    """ Match two sets of ids, all at once.
+        If the ids span a range not much larger than their number, they
+        are looked up in a table indexed by id; otherwise both sets are
+        sorted and matched with a single searchsorted.
+        Returns:
+          ibest -- array of indices of id1 that match id2; -1 if no match
+    """
+    cdef numpy.ndarray[DTYPE_t, ndim=1] indices, idsorted, order, i, ibest, table
+    id1 = numpy.asarray(id1, dtype=DTYPE)
+    id2 = numpy.asarray(id2, dtype=DTYPE)
+    if len(id1) == 0 or len(id2) == 0:
+        return numpy.zeros(len(id2), dtype=DTYPE) - 1
+    idmin = id1.min()
+    span = id1.max() - idmin + 1
+    if span <= 4 * (len(id1) + len(id2)):
+        table = numpy.zeros(span, dtype=DTYPE) - 1
+        table[id1 - idmin] = numpy.arange(len(id1), dtype=DTYPE)
+        i = id2 - idmin
+        inrange = (i >= 0) & (i < span)
+        ibest = numpy.zeros(len(id2), dtype=DTYPE) - 1
+        ibest[inrange] = table[i[inrange]]
+        return ibest
+    indices = numpy.argsort(id1).astype(DTYPE)
+    idsorted = id1[indices]
+    # searching for sorted ids is much faster than for ids in random order
+    order = numpy.argsort(id2).astype(DTYPE)
+    i = numpy.searchsorted(idsorted, id2[order]).astype(DTYPE)
+    i[i == len(idsorted)] = 0
+    ibest = numpy.zeros(len(id2), dtype=DTYPE)
+    ibest[order] = numpy.where(idsorted[i] == id2[order], indices[i], -1)
+    return ibest
+
+
+def matchids_loop(numpy.ndarray[DTYPE_t, ndim=1] id1, numpy.ndarray[DTYPE_t, ndim=1] id2):
+    """ Previous version of matchids, searching for each id in turn, kept for
+        comparison.  Unmatched ids are given index 0.
     """
     assert id1.dtype == DTYPE and id2.dtype == DTYPE
     cdef numpy.ndarray[DTYPE_t, ndim=1] indices, idsorted, ibest
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+
+"""mz_batch.py - Run mz_cluster for each job in a manifest, in parallel.
+
+    Version 2014-03-28
+
+    Usage:
+        mz_batch.py <manifest_json>
+
+    Usage example:
+        python mz_batch.py a17_clustering_2014-03-14.json
+
+    The manifest is a json object with a list of "jobs", each a dict of
+    mz_cluster keyword arguments, and optionally a dict of "defaults"
+    shared by all the jobs, e.g.
+
+        {"defaults": {"threshold": 1.0, "position_scale": 0.25, "size_scale": 0.25,
+                      "min_user_weight": 100, "long_min": 30.699, "long_max": 30.880,
+                      "lat_min": 20.200, "lat_max": 20.275},
+         "jobs": [{"nac": "M104311715RE", "grid": {"mincount": [1, 2, 3, 4]},
+                   "output_filename_base": "clusters/{nac}_c_{mincount}",
+                   "moonzoo_markings_csv": "markings/{nac}.csv", "nac_names": "{nac}"}]}
+
+    A job with a "grid" of lists (which may also be in the defaults) is
+    run for every combination of their values.  String arguments are formatted with the job's values, so
+    other keys (like "nac" above) may be given just for naming files.  A
+    job may give "memory_mb", its expected peak memory.
+
+    Each job is run in its own process, with its output in
+    <output_filename_base>.out, so a job that fails or is killed does not
+    affect the others.  As many jobs are run at once as there are cores,
+    and as fit in the available memory.  The jobs that finish are
+    recorded in <manifest_json>.state as they do, so running the same
+    manifest again only runs the jobs that have failed, have not been
+    run, or whose arguments have changed.
+
+    Options:
+        -n <nprocs>     most jobs to run at once (default all cores)
+        -m <memory_mb>  expected peak memory of a job (default from the
+                        job's last report, or default_job_memory_mb)
+        -f              run all jobs, even if finished before
+
+"""
+
+import os, sys, getopt, json, time, inspect, traceback
+from itertools import product
+from multiprocessing import Process, cpu_count
+import mz_cluster as mzc
+
+default_job_memory_mb = 4000  # expected peak memory of a job with no report
+state_suffix = '.state'  # of the file recording the finished jobs
+poll_interval = 1.0  # seconds between checks on the running jobs
+
+_mz_cluster_args = inspect.getargspec(mzc.mz_cluster).args
+
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def read_manifest(manifest_json):
+    """Read a manifest into a list of jobs, each a dict of mz_cluster arguments.
+
+    The grids of the manifest's jobs are expanded, and the string values
+    formatted, as described in the module docstring.
+
+    """
+    manifest = json.load(open(manifest_json))
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for entry in manifest['jobs']:
+        grid = dict(defaults.get('grid', {}))
+        grid.update(entry.get('grid', {}))
+        names = sorted(grid)
+        for values in product(*[grid[name] for name in names]):
+            job = dict(defaults)
+            job.update(entry)
+            job.pop('grid', None)
+            job.update(zip(names, values))
+            jobs.append(make_job(job))
+    bases = [job['kwargs']['output_filename_base'] for job in jobs]
+    if len(set(bases)) != len(bases):
+        raise ValueError('Jobs in %s share an output_filename_base'%manifest_json)
+    return jobs
+
+
+def make_job(values):
+    # a job of mz_cluster arguments, with its strings formatted by all its values
+    values = dict((key, value.format(**values) if isinstance(value, basestring) else value)
+                  for key, value in values.items())
+    if 'output_filename_base' not in values:
+        raise ValueError('Job has no output_filename_base: %r'%values)
+    kwargs = dict((key, value) for key, value in values.items() if key in _mz_cluster_args)
+    kwargs.setdefault('plots', 'serial')
+    return {'kwargs': kwargs, 'memory_mb': values.get('memory_mb')}
+
+
+def job_memory(job, memory_mb=None):
+    # expected peak memory of job, in MB
+    if job['memory_mb'] is not None:
+        return job['memory_mb']
+    if memory_mb is not None:
+        return memory_mb
+    try:
+        report = json.load(open(job['kwargs']['output_filename_base'] + '_report.json'))
+        return max(stage['peak_rss_mb'] for stage in report['stages'])
+    except (IOError, ValueError, KeyError):
+        return default_job_memory_mb
+
+
+def available_memory():
+    # memory available for new processes, in MB, or None if unknown
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024.0**2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def read_batch_state(filename):
+    # finished jobs, by output_filename_base
+    if not os.path.exists(filename):
+        return {}
+    return json.load(open(filename))
+
+
+def write_batch_state(filename, state):
+    # write to a temporary file first, so an interrupted batch leaves the last state intact
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+def job_finished(job, state):
+    # whether job finished before, with the same arguments, and its catalogue is still there
+    base = job['kwargs']['output_filename_base']
+    done = state.get(base)
+    if done is None or done['status'] != 'done' or done['kwargs'] != job['kwargs']:
+        return False
+    return os.path.exists(mzc.crater_cat_filename(base, job['kwargs'].get('catalogue_format', 'csv')))
+
+
+def run_job(kwargs):
+    # run in a new process, with its stdout and stderr, and those of any C code, in <base>.out
+    log = open(kwargs['output_filename_base'] + '.out', 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        mzc.mz_cluster(**kwargs)
+        mzc.wait_for_plots()
+    except:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+def batch(jobs, state_filename, nprocs=None, memory_mb=None, clobber=False):
+    """Run mz_cluster for each of jobs, as many at once as fit.
+
+    Jobs are started in order while fewer than nprocs (default all cores)
+    are running and their expected memory (see job_memory) fits in what
+    is available, though one is always allowed to run.  Each finished or
+    failed job is recorded in state_filename straight away, and jobs
+    recorded as finished are skipped unless clobber is True.  Returns the
+    output_filename_base of each job that failed.
+
+    """
+    if nprocs is None:
+        nprocs = cpu_count()
+    state = read_batch_state(state_filename)
+    pending = []
+    for job in jobs:
+        if not clobber and job_finished(job, state):
+            print('Skipping finished job %s'%job['kwargs']['output_filename_base'])
+        else:
+            pending.append(job)
+    print('Running %i of %i jobs'%(len(pending), len(jobs)))
+    # jobs only reach their peak memory some time after starting, so
+    # their expected memory is reserved from what was available at first
+    memory = available_memory()
+    for job in pending:
+        job['memory_mb'] = job_memory(job, memory_mb)
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < nprocs:
+            reserved = sum(job['memory_mb'] for job, process, start in running)
+            if running and memory is not None and reserved + pending[0]['memory_mb'] > memory:
+                break
+            job = pending.pop(0)
+            dirname = os.path.dirname(job['kwargs']['output_filename_base'])
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            process = Process(target=run_job, args=(job['kwargs'],))
+            process.start()
+            running.append((job, process, time.time()))
+            print('Started %s'%job['kwargs']['output_filename_base'])
+        time.sleep(poll_interval)
+        for job, process, start in running[:]:
+            if process.is_alive():
+                continue
+            process.join()
+            running.remove((job, process, start))
+            base = job['kwargs']['output_filename_base']
+            status = 'done' if process.exitcode == 0 else 'failed'
+            state[base] = {'status': status, 'exitcode': process.exitcode, 'kwargs': job['kwargs'],
+                           'wall': round(time.time() - start, 3), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            write_batch_state(state_filename, state)
+            if status == 'failed':
+                failed.append(base)
+                print('Failed %s with exit code %i, see %s.out'%(base, process.exitcode, base))
+            else:
+                print('Finished %s'%base)
+    return failed
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hfn:m:", ["help", "force", "nprocs=", "memory="])
+        except getopt.error, msg:
+            raise Usage(msg)
+        clobber = False
+        nprocs = memory_mb = None
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                print __doc__
+                return 1
+            if o in ("-f", "--force"):
+                clobber = True
+            if o in ("-n", "--nprocs"):
+                nprocs = int(a)
+            if o in ("-m", "--memory"):
+                memory_mb = float(a)
+        if len(args) != 1:
+            raise Usage("Requires a manifest json filename")
+        try:
+            jobs = read_manifest(args[0])
+        except (IOError, ValueError, KeyError), err:
+            raise Usage("Could not read manifest %s: %s"%(args[0], err))
+        failed = batch(jobs, args[0] + state_suffix, nprocs, memory_mb, clobber)
+        if failed:
+            print >>sys.stderr, "%i jobs failed: %s"%(len(failed), ', '.join(failed))
+            return 1
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "For help use --help"
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
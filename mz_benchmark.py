@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+
+"""mz_benchmark.py - Time the stages of mz_cluster on synthetic markings.
+
+    Version 2014-03-27
+
+    Usage:
+        mz_benchmark.py <output_json> [<nmarkings> ...]
+        mz_benchmark.py -c <old_json> <new_json>
+
+    Usage examples:
+        python mz_benchmark.py benchmark.json 1000 10000 100000 1000000
+        python mz_benchmark.py -c benchmark_old.json benchmark.json
+
+    For each number of markings (default 10^3 to 10^6) a synthetic set of
+    markings is made with make_test_craters, with ten observations of
+    each crater, in a temporary directory.  It is then taken through the
+    stages of mz_cluster in turn: load, weight, cluster, aggregate,
+    offset, compare and plot.  The wall time, CPU time (of this process
+    and of any child processes) and peak resident memory of each stage
+    are written to output_json, with the git revision of the code, so
+    runs can be compared across versions with -c.
+
+    The stages are measured with mz_cluster's StageReport, so peak memory
+    is that of this process during the stage where the kernel allows the
+    peak to be reset (Linux), and otherwise the peak so far.
+
+    Options:
+        -e <engine>  clustering engine, as for mz_cluster (default 'tree')
+        -s <seed>    random seed for the synthetic markings (default 1)
+        -v           show the output of mz_cluster's functions
+        -b           generate and load the markings as a marking store, not csv
+        -f           overwrite output_json
+
+"""
+
+import os, sys, getopt, json, time, shutil, tempfile, subprocess
+from multiprocessing import cpu_count
+import numpy
+import mz_cluster as mzc
+import crater_metrics
+
+stage_names = ('generate', 'load', 'weight', 'cluster', 'aggregate', 'offset', 'compare', 'plot')
+
+default_nmarkings = (10**3, 10**4, 10**5, 10**6)
+
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def benchmark_run(nmarkings, engine='tree', seed=1, quiet=True, store=False, threshold=1.0, mincount=2,
+                  maxcount=10, maxiter=3, position_scale=0.2, size_scale=0.2, min_user_weight=100):
+    """Time each stage of mz_cluster for nmarkings synthetic markings.
+
+    Must be run in a directory where the synthetic markings, truth
+    catalogue and plots may be written.  If store is True the markings
+    are written to, and loaded from, a marking store rather than csv.  The other arguments are as for
+    mz_cluster; min_user_weight >= 100 ignores user weights, as the
+    synthetic markings have no users.  Returns a dict of the number of
+    markings asked for, the number within the truth catalogue's region,
+    the number of craters found, the measurements of each stage and the
+    counts of clustering iterations.
+
+    """
+    report = mzc.StageReport()
+    nobs = 10
+    ncraters = max(nmarkings // nobs, 1)
+    crater_metrics.pscale = position_scale
+    crater_metrics.sscale = size_scale
+    # so the counts of iterative_fastclusterdata are kept
+    mzc._report = report
+    if quiet:
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        report.stage('generate')
+        markings = 'testcraters' if store else 'testcraters.csv'
+        mzc.make_test_craters(ncraters=ncraters, nobs=nobs, seed=seed, markings_filename=markings)
+        report.stage('load')
+        truth = mzc.read_truth('truthcraters.csv')
+        points = mzc.load_markings(markings)
+        long_min, long_max = truth['long'].min(), truth['long'].max()
+        lat_min, lat_max = truth['lat'].min(), truth['lat'].max()
+        report.stage('weight')
+        points, user_weights = mzc.select_markings(points, long_min, long_max, lat_min, lat_max, min_user_weight)
+        truth = mzc.select_truth(truth, long_min, long_max, lat_min, lat_max, points['radius'].min())
+        report.stage('cluster')
+        clusters = mzc.iterative_fastclusterdata(points.X.T, threshold, maxcount, mincount, maxiter, engine)
+        report.stage('aggregate')
+        crater_mean, crater_stdev, crater_count, crater_score, crater_countnotmin, dra, drs, ds, s, notmin = \
+            mzc.aggregate_clusters(points, user_weights, clusters, mincount)
+        crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin = \
+            mzc.select_craters(crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin, mincount)
+        report.stage('offset')
+        offset = mzc.find_offset(truth, crater_mean)
+        crater_mean_offset = mzc.apply_offset(crater_mean, offset)
+        report.stage('compare')
+        mzc.compare(crater_mean_offset, truth)
+        mzc.sizefreq_stats(crater_mean_offset, truth)
+        report.stage('plot')
+        base = 'benchmark'
+        mzc.plot_cluster_stats(dra, drs, ds, s, notmin, base)
+        mzc.plot_crater_stats(crater_mean, truth, base)
+        mzc.plot_cluster_diagnostics(points, crater_mean, truth, long_min, long_max, lat_min, lat_max, base)
+        mzc.plot_craters(points, crater_mean, truth, long_min, long_max, lat_min, lat_max, base,
+                         user_weights, crater_score)
+        report.stage(None)
+    finally:
+        mzc._report = None
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    print(report.summary())
+    return {'nmarkings': nmarkings, 'nselected': len(points), 'ncraters': len(crater_mean),
+            'stages': report.stages, 'counts': report.counts}
+
+
+def benchmark(nmarkings=default_nmarkings, engine='tree', seed=1, quiet=True, store=False, **kwargs):
+    # run benchmark_run for each size, each in a new temporary directory
+    runs = []
+    cwd = os.getcwd()
+    for n in nmarkings:
+        print('\n*** Benchmarking %i markings ***'%n)
+        workdir = tempfile.mkdtemp(prefix='mz_benchmark_')
+        os.chdir(workdir)
+        try:
+            runs.append(benchmark_run(n, engine, seed, quiet, store, **kwargs))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+    return {'revision': git_revision(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': os.uname()[1], 'ncpus': cpu_count(), 'python': sys.version.split()[0],
+            'numpy': numpy.__version__, 'engine': engine, 'seed': seed, 'store': store, 'runs': runs}
+
+
+def git_revision():
+    # revision of the working tree holding this file, or None
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                               cwd=path, stderr=devnull)
+        return revision.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_benchmarks(old_json, new_json):
+    # print the ratio of new to old wall time and peak memory of each stage
+    old, new = (json.load(open(f)) for f in (old_json, new_json))
+    print('%s (%s) / %s (%s)'%(new_json, new['revision'], old_json, old['revision']))
+    print('%10s %10s %10s %10s'%('nmarkings', 'stage', 'wall', 'peak_rss'))
+    old_runs = dict((run['nmarkings'], run) for run in old['runs'])
+    for run in new['runs']:
+        if run['nmarkings'] not in old_runs:
+            continue
+        old_stages = dict((stage['name'], stage) for stage in old_runs[run['nmarkings']]['stages'])
+        new_stages = dict((stage['name'], stage) for stage in run['stages'])
+        for name in stage_names:
+            if name in new_stages and name in old_stages:
+                a, b = old_stages[name], new_stages[name]
+                print('%10i %10s %10.3f %10.3f'%(run['nmarkings'], name, b['wall'] / max(a['wall'], 1e-9),
+                                                  b['peak_rss_mb'] / max(a['peak_rss_mb'], 1e-9)))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hfce:s:vb", ["help", "force", "compare", "engine=",
+                                                               "seed=", "verbose", "binary"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        clobber = compare = store = False
+        quiet = True
+        engine = 'tree'
+        seed = 1
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                print __doc__
+                return 1
+            if o in ("-f", "--force"):
+                clobber = True
+            if o in ("-c", "--compare"):
+                compare = True
+            if o in ("-e", "--engine"):
+                engine = a
+            if o in ("-s", "--seed"):
+                seed = int(a)
+            if o in ("-v", "--verbose"):
+                quiet = False
+            if o in ("-b", "--binary"):
+                store = True
+        if compare:
+            if len(args) != 2:
+                raise Usage("Comparison requires two benchmark json files")
+            compare_benchmarks(*args)
+            return 0
+        if len(args) < 1:
+            raise Usage("Requires an output json filename")
+        output = args[0]
+        if os.path.exists(output) and (not clobber):
+            raise Usage("Output file already exists: %s\nUse -f to overwrite."%output)
+        nmarkings = [int(float(a)) for a in args[1:]] or default_nmarkings
+        results = benchmark(nmarkings, engine, seed, quiet, store)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "For help use --help"
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""mz_catalogue.py - Read and write the crater catalogues made by mz_cluster.
+
+    Version 2014-03-26
+
+    A catalogue may be written as a csv file (<base>_craters.csv, as it
+    always has been) or as a binary .npy file of records
+    (<base>_craters.npy), which is read back without any text parsing
+    and may be memory mapped.  A .npy catalogue may also be written a
+    tile or region at a time, with append_crater_cat.
+
+    h5py is not one of the pipeline's dependencies, so there is no HDF5
+    writer, but one can be added to catalogue_writers in the same way.
+
+"""
+
+import os
+import numpy
+from numpy.lib import format as npyformat
+
+crater_cat_columns = [(name, numpy.double) for name in
+                      ('long', 'long_std', 'lat', 'lat_std', 'radius', 'radius_std',
+                       'axialratio', 'axialratio_std', 'angle', 'angle_std',
+                       'boulderyness', 'boulderyness_std', 'score')]
+crater_cat_columns += [('count', numpy.int64), ('countnotmin', numpy.int64)]
+crater_cat_dtype = numpy.dtype(crater_cat_columns)
+
+# bytes reserved for the header of an appendable .npy catalogue,
+# enough for any number of rows
+appendable_header_size = 1024
+
+
+def make_crater_cat(crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin):
+    cat = numpy.zeros(len(crater_mean), crater_cat_dtype)
+    for name in crater_mean.dtype.names:
+        cat[name] = crater_mean[name]
+        cat[name+'_std'] = crater_stdev[name]
+    cat['score'] = crater_score
+    cat['count'] = crater_count
+    cat['countnotmin'] = crater_countnotmin
+    return cat.view(numpy.recarray)
+
+
+def write_cat_csv(filename, cat):
+    fout = open(filename, 'w')
+    fout.write(','.join(cat.dtype.names)+'\n')
+    outarray = numpy.array([cat[name] for name in cat.dtype.names], numpy.float)
+    numpy.savetxt(fout, outarray.T, delimiter=", ", fmt='%.6f')
+    fout.close()
+
+
+def write_cat_npy(filename, cat):
+    numpy.save(filename, numpy.asarray(cat).view(numpy.ndarray))
+
+
+# writers of any record array catalogue, by format and file extension
+catalogue_writers = {'csv': write_cat_csv, 'npy': write_cat_npy}
+
+
+def catalogue_format(filename):
+    return 'npy' if filename.endswith('.npy') else 'csv'
+
+
+def write_cat(filename, cat):
+    # write with the writer for the file's extension
+    catalogue_writers[catalogue_format(filename)](filename, cat)
+
+
+def crater_cat_filename(output_filename_base, format='csv'):
+    return output_filename_base + '_craters.' + format
+
+
+def read_crater_cat(filename, mmap_mode=None):
+    # A record array from a .npy catalogue, or from any csv file with column headers
+    if catalogue_format(filename) == 'npy':
+        return numpy.load(filename, mmap_mode=mmap_mode).view(numpy.recarray)
+    return numpy.genfromtxt(filename, delimiter=',', names=True).view(numpy.recarray)
+
+
+def append_crater_cat(filename, cat):
+    """Add the craters in cat to the end of a .npy catalogue.
+
+    The file is made if it does not exist, and otherwise must have been
+    made by append_crater_cat.  Its header has room for any number of
+    rows, so only the header and the new rows are written.
+
+    """
+    cat = numpy.asarray(cat, crater_cat_dtype)
+    if not os.path.exists(filename):
+        fout = open(filename, 'wb')
+        write_appendable_header(fout, 0)
+        nrows = 0
+    else:
+        fout = open(filename, 'r+b')
+        npyformat.read_magic(fout)
+        shape, fortran_order, dtype = npyformat.read_array_header_1_0(fout)
+        if dtype != crater_cat_dtype or fout.tell() != appendable_header_size:
+            fout.close()
+            raise ValueError('%s is not an appendable crater catalogue'%filename)
+        nrows = shape[0]
+    fout.seek(appendable_header_size + nrows * crater_cat_dtype.itemsize)
+    fout.write(cat.tostring())
+    fout.seek(0)
+    write_appendable_header(fout, nrows + len(cat))
+    fout.close()
+
+
+def write_appendable_header(fout, nrows):
+    # a version 1.0 .npy header, padded with spaces to appendable_header_size
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }"%(
+        npyformat.dtype_to_descr(crater_cat_dtype), nrows)
+    header = header.ljust(appendable_header_size - 10 - 1) + '\n'
+    fout.write(npyformat.magic(1, 0))
+    fout.write(numpy.array([len(header)], '<u2').tostring())
+    fout.write(header)
@@ -10,27 +10,45 @@
                       <min_user_weight> <long_min> <long_max> <lat_min> <lat_max>
 
     Note that the csv files must contain column headers, including 'long', 'lat' and 'xradius'.
+
+    Use -c (--catalogue-only) to only write the crater catalogues, without any plots.
+
+    Use -b (--binary) to write the crater catalogues as .npy files, rather than csv.
+
+    Use -s (--save-state) to keep the clustering, so that a later batch of new
+    markings can be added to it, without clustering everything again, with:
+        mz_cluster.py -u <output_filename_base> <new_moonzoo_markings_csv>
+
+    A report of the time and memory used by each stage is written to
+    <output_filename_base>_report.json.  Use -p (--profile) to also write
+    cProfile statistics to <output_filename_base>.prof.
     
     Usage example:
         python mz_cluster.py mz_clusters data/M104311715/craters_RE_latlong.csv data/M104311715/715_xpert.csv 
 
 """
 
-import os, sys, getopt
+import os, sys, getopt, atexit, shutil, json, time, resource, cProfile
+from multiprocessing import Pool, cpu_count
 from string import strip
 from math import sqrt, pi
 import numpy
 import matplotlib
 matplotlib.use('PDF')
 import matplotlib.pyplot as pyplot
-from matplotlib.patches import Ellipse
+from matplotlib.collections import EllipseCollection
 from scipy.optimize import fmin_powell as fmin
 from scipy.stats import scoreatpercentile, ks_2samp
+from scipy.spatial import cKDTree
 import scipy.cluster
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
 import fastcluster
-from collections import Container
 from numpy.lib.recfunctions import append_fields
 import pymysql
+from mz_markings import (read_markings, read_marking_columns, is_marking_store, create_marking_store,
+                         marking_columns, marking_names)
+from mz_catalogue import make_crater_cat, catalogue_writers, crater_cat_filename
 
 # Some debugging tools:
 #from IPython import embed
@@ -41,7 +59,7 @@ import pymysql
 import pyximport; pyximport.install(setup_args={"include_dirs":numpy.get_include()})
 from matchids import matchids
 import crater_metrics
-from crater_metrics import crater_cdist, crater_pdist, crater_absolute_position_metric, crater_position_metric, crater_size_metric,lunar_radius, crater_metric_one as crater_metric
+from crater_metrics import crater_cdist, crater_pdist, crater_pdist_sparse, crater_neighbour_graph, crater_neighbour_pairs_of, crater_graph, crater_nearest, crater_unit_vectors, crater_pair_components, crater_absolute_position_metric, crater_position_metric, crater_size_metric,lunar_radius, crater_metric_one as crater_metric
 
 matplotlib.rcParams.update({'font.size': 14})
 
@@ -49,11 +67,33 @@ degrees_per_metre = 360.0 / (2*pi*lunar_radius)
 
 minsize_factor = 0.5  # downweight minsize markings by this factor
 
+user_weights_cache = 'user_weights_cache'  # directory for cached user weights
+unknown_user_weight = 1.0  # weight of users missing from the user_weights table
+
+_db_connections = {}  # open database connections, by process id and database name
+
+max_vector_craters = 10000  # draw_craters rasterizes more craters than this
+
+plot_nprocs = 4  # processes for making plots in the background
+
+image_cache = 'image_cache'  # directory for downsampled background images
+
+coverage_cache = 'coverage_cache'  # directory for coverage rasters
+coverage_resolution = 0.0005  # size of coverage raster pixels, in degrees
+_coverage = {}  # coverage rasters already read, by database and NAC name
+min_pyramid_size = 256  # smallest image pyramid level, in pixels
+_plot_pool = None
+_plot_jobs = []  # results of the plots submitted to _plot_pool
+
+_report = None  # StageReport of the mz_cluster run in progress, for count_event
+
 def mz_cluster(output_filename_base='mz_clusters', moonzoo_markings_csv='none',
                nac_names='none', expert_markings_csv='none', image='none',
                threshold=1.0, mincount=2.0, maxcount=10, maxiter=3,
                position_scale=0.2, size_scale=0.2, min_user_weight=0.5,
-               long_min=-1.0, long_max=361.0, lat_min=-91.0, lat_max=91.0):
+               long_min=-1.0, long_max=361.0, lat_min=-91.0, lat_max=91.0, engine='tree',
+               nprocs=None, plots='background', catalogue_format='csv', save_state=False,
+               profile=False):
     #long_min=30.655, long_max=30.800, lat_min=20.125, lat_max=20.255):
     """Runs clustering routine.
 
@@ -68,7 +108,8 @@ def mz_cluster(output_filename_base='mz_clusters', moonzoo_markings_csv='none',
      
     Keyword arguments:
     output_filename_base -- basename of all output files
-    moonzoo_markings_csv -- name of file containing raw crater markings
+    moonzoo_markings_csv -- name of file containing raw crater markings,
+                            or of a marking store made by mz_markings.py
     nac_names -- comma separated list of all NAC names contributing to markings file
     expert_markings_csv -- name of file containing expert craters
     image -- image to put underneath crater plots
@@ -82,6 +123,33 @@ def mz_cluster(output_filename_base='mz_clusters', moonzoo_markings_csv='none',
     min_user_weight -- minimum user weight to be included at all
                        if this is >= 100, then user weights are ignored
     long_min, long_max, lat_min, lat_max -- limits of region to consider
+    engine -- 'tree' to find linked markings with a KD-tree (scales to
+              full NACs), 'tiled' to do the same in parallel tiles,
+              'banded' to do the same in overlapping bands of log radius,
+              only comparing markings of similar size, except for
+              minimum size markings,
+              'sparse' to use a blocked, thresholded distance graph,
+              'fastcluster' to use the full distance matrix, or 'dbscan'
+              to use dbscanclusterdata, with at least mincount markings
+              in the neighbourhood of a cluster's core markings, in place
+              of single linkage and the splitting of large clusters
+    nprocs -- number of processes for the 'tiled' engine, default all cores
+    plots -- 'background' to make the plots in a pool of plot_nprocs
+             processes, so this returns while they are drawn (call
+             wait_for_plots to wait for them), 'serial' to make them
+             before returning, or 'none' to only write the catalogues
+    catalogue_format -- 'csv' to write <output_filename_base>_craters.csv,
+                        or 'npy' to write a binary <output_filename_base>_craters.npy,
+                        which mz_catalogue.read_crater_cat reads without text parsing
+    save_state -- if True, keep the clustering in <output_filename_base>_state.npz,
+                  so new markings can be added with mz_cluster_update
+    profile -- if True, also write cProfile statistics to <output_filename_base>.prof
+
+    The wall time, CPU time, peak memory and number of crater_metric
+    pairs of each stage, counts of the clustering iterations, and the
+    histograms of cluster and crater sizes (numbers of markings), are
+    written to <output_filename_base>_report.json.  With plots in the
+    background, the plot stage only includes submitting them.
     
     This could incorporate user weighting in future, e.g. by assigning
     clusters scores based on the sum of the user weights for each
@@ -94,54 +162,269 @@ def mz_cluster(output_filename_base='mz_clusters', moonzoo_markings_csv='none',
     print('threshold = %f\nmincount = %f\nmaxcount = %i\nmaxiter = %i'%(threshold, mincount, maxcount, maxiter))
     print('position_scale = %f\nsize_scale = %f\nmin_user_weight = %f'%(position_scale, size_scale, min_user_weight))
     print
-    # set variables for crater metric
-    crater_metrics.pscale = position_scale
-    crater_metrics.sscale = size_scale
-    # read in all data
-    nac_names = nac_names.upper().split(',')
-    test=False
-    if moonzoo_markings_csv.lower() == 'none':
-        # If no filename specified, generate and use test data
-        test = True
-        make_test_craters(ncraters=100, nobs=10)
-        expert_markings_csv = 'truthcraters.csv'
-        moonzoo_markings_csv = 'testcraters.csv'
-    truth = None
-    if expert_markings_csv.lower() != 'none':
-        # If 'truth' data is supplied, use it in plots
-        truth = numpy.genfromtxt(expert_markings_csv, delimiter=',', names=True)
-        if truth.dtype.names[:3] != ('long', 'lat', 'radius'):
-            # this is a cat from Rob, rather than an internal test cat
-            # the format of these files changes every time
-            #truth.dtype.names = ('long', 'lat', 'radius') + truth.dtype.names[3:]
-            truth.dtype.names = ('radius', 'x', 'y', 'long', 'lat')
-            #truth['radius'] /= 2.0  # fix diameter to radius
-            n = len(truth)
-            truth = numpy.rec.fromarrays([truth['long'], truth['lat'], truth['radius'],
-                                          numpy.ones(n, numpy.float), numpy.zeros(n, numpy.float),
-                                          numpy.zeros(n, numpy.float)],
-                                          names=('long', 'lat', 'radius', 'axialratio', 'angle',
-                                                 'boulderyness'))
-        datarange = (truth['long'].min(), truth['long'].max(), truth['lat'].min(), truth['lat'].max())
-        print('Expert data covers region: long=(%.3f, %.3f), lat=(%.3f, %.3f)'%datarange)
-        if test:
-            long_min, long_max, lat_min, lat_max = datarange
-    # Get markings data
-    points = numpy.recfromtxt(moonzoo_markings_csv, delimiter=',', names=True)
-    if points.dtype.names[:3] != ('long', 'lat', 'radius'):
-        # this is a cat from Rob, rather than one produced from the pipeline
-        points.dtype.names = ('long', 'lat', 'radius') + points.dtype.names[3:]
-        n = len(points)
-        points = numpy.rec.fromarrays([points['long'], points['lat'], points['radius'],
-                                       numpy.ones(n, numpy.float), numpy.zeros(n, numpy.float),
-                                       numpy.zeros(n, numpy.float), numpy.zeros(n, numpy.bool),
-                                       numpy.zeros(n, numpy.int)],
-                                       names=('long', 'lat', 'radius', 'axialratio', 'angle',
-                                              'boulderyness', 'minsize', 'user'))
-    datarange = (points['long'].min(), points['long'].max(), points['lat'].min(), points['lat'].max())
-    print('Markings cover region: long=(%.3f, %.3f), lat=(%.3f, %.3f)'%datarange)
-    # Select region of interest
-    print('Considering region: long=(%.3f, %.3f), lat=(%.3f, %.3f)'%(long_min, long_max, lat_min, lat_max))
+    global _report
+    _report = report = StageReport()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        report_filename_base = output_filename_base
+        parameters = dict(moonzoo_markings_csv=moonzoo_markings_csv, expert_markings_csv=expert_markings_csv,
+                          threshold=threshold, mincount=mincount, maxcount=maxcount, maxiter=maxiter,
+                          position_scale=position_scale, size_scale=size_scale, min_user_weight=min_user_weight,
+                          region=(long_min, long_max, lat_min, lat_max), engine=engine)
+        # set variables for crater metric
+        crater_metrics.pscale = position_scale
+        crater_metrics.sscale = size_scale
+        # read in all data
+        nac_names = nac_names.upper().split(',')
+        test=False
+        if moonzoo_markings_csv.lower() == 'none':
+            # If no filename specified, generate and use test data
+            test = True
+            report.stage('generate')
+            make_test_craters(ncraters=100, nobs=10)
+            expert_markings_csv = 'truthcraters.csv'
+            moonzoo_markings_csv = 'testcraters.csv'
+        report.stage('load')
+        truth = None
+        if expert_markings_csv.lower() != 'none':
+            # If 'truth' data is supplied, use it in plots
+            truth = read_truth(expert_markings_csv)
+            datarange = (truth['long'].min(), truth['long'].max(), truth['lat'].min(), truth['lat'].max())
+            print('Expert data covers region: long=(%.3f, %.3f), lat=(%.3f, %.3f)'%datarange)
+            if test:
+                long_min, long_max, lat_min, lat_max = datarange
+        # Get markings data
+        points = load_markings(moonzoo_markings_csv, (long_min, long_max, lat_min, lat_max))
+        datarange = (points['long'].min(), points['long'].max(), points['lat'].min(), points['lat'].max())
+        print('Markings cover region: long=(%.3f, %.3f), lat=(%.3f, %.3f)'%datarange)
+        # Select region of interest
+        print('Considering region: long=(%.3f, %.3f), lat=(%.3f, %.3f)'%(long_min, long_max, lat_min, lat_max))
+        report.stage('weight')
+        points, user_weights = select_markings(points, long_min, long_max, lat_min, lat_max, min_user_weight)
+        smallest_radius = points['radius'].min()
+        smallest_expert_radius = truth['radius'].min() if truth is not None else 0.0
+        if truth is not None:
+            truth = select_truth(truth, long_min, long_max, lat_min, lat_max, smallest_radius)
+        print('\nNumber of markings: %i'%points.shape[0])
+        print('Radius of smallest marking: %.3f'%smallest_radius)
+        if truth is not None:
+            print('Number of expert markings: %i'%truth.shape[0])
+            print('Radius of smallest expert marking: %.3f'%smallest_expert_radius)
+        # Perform clustering of markings
+        report.stage('cluster')
+        if save_state:
+            if engine == 'dbscan':
+                raise ValueError('save_state needs a single linkage engine, not dbscan')
+            components, edges = linkclusterdata(points.X, threshold, engine, nprocs)
+        else:
+            edges = None
+        if engine == 'dbscan':
+            clusters = dbscanclusterdata(points.X, threshold, int(numpy.ceil(mincount)))
+        else:
+            clusters = iterative_fastclusterdata(points.X.T, threshold, maxcount, mincount, maxiter, engine, nprocs,
+                                                 edges)
+        # Previous clustering methods:
+        ### clusters = fastclusterdata(p, t=threshold, criterion='distance', method='single')
+        ### clusters = dbscanclusterdata(p, t=threshold, m=mincount)
+        ### clusters = scipy.cluster.hierarchy.fclusterdata(p, t=threshold, criterion='distance', method='single', metric='euclidean')
+        ### clusters = scipy.cluster.hierarchy.fclusterdata(p, t=threshold, criterion='inconsistent', method='single', metric='euclidean')
+        # Calculate clustered crater properties and useful stats
+        # while eliminating clusters with too few markings
+        report.stage('aggregate')
+        nclusters = clusters.max()
+        print('\nFound %i initial clusters'%nclusters)
+        crater_mean, crater_stdev, crater_count, crater_score, crater_countnotmin, dra, drs, ds, s, notmin = \
+            aggregate_clusters(points, user_weights, clusters, mincount)
+        if save_state:
+            state = dict(
+                points=points.to_records(), user_weights=user_weights, components=components, edges=numpy.array(edges),
+                clusters=clusters, crater_mean=crater_mean, crater_stdev=crater_stdev, crater_count=crater_count,
+                crater_score=crater_score, crater_countnotmin=crater_countnotmin,
+                threshold=threshold, mincount=mincount, maxcount=maxcount, maxiter=maxiter,
+                position_scale=position_scale, size_scale=size_scale, min_user_weight=min_user_weight,
+                region=(long_min, long_max, lat_min, lat_max))
+        cluster_count = crater_count
+        crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin = \
+            select_craters(crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin, mincount)
+        print('Found %i final clusters'%len(crater_count))
+
+        crater_mean_for_comparison = crater_mean[crater_mean['radius'] > smallest_expert_radius]
+        print('Only computing stats for set of %i craters larger than smallest truth crater'%len(crater_mean_for_comparison))
+
+        # Write final crater catalogue
+        report.stage('write')
+        write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin,
+                         catalogue_format)
+        if save_state:
+            write_cluster_state(output_filename_base, state)
+        report.stage('compare')
+        if truth is not None:
+            stats = sizefreq_stats(crater_mean_for_comparison, truth)
+            print_sizefreq_stats(stats)
+        else:
+            stats = None
+        # Make some plots
+        report.stage('plot')
+        if plots != 'none':
+            background = plots == 'background'
+            submit_plot(background, plot_cluster_stats, dra, drs, ds, s, notmin, output_filename_base)
+            submit_plot(background, plot_crater_stats, crater_mean_for_comparison, truth, output_filename_base, stats)
+            submit_plot(background, plot_cluster_diagnostics, points, crater_mean, truth,
+                        long_min, long_max, lat_min, lat_max, output_filename_base)
+            submit_plot(background, plot_craters, points, crater_mean, truth, long_min, long_max, lat_min, lat_max,
+                        output_filename_base, user_weights, crater_score, img=image)
+            if len(nac_names) > 0 and nac_names != ['NONE']:
+                submit_plot(background, plot_coverage, long_min, long_max, lat_min, lat_max, output_filename_base,
+                            nac_names=nac_names, img=image)
+
+        report.stage('compare')
+        if truth is not None:
+            matchval = compare(crater_mean_for_comparison, truth)
+            print("\nMedian metric distance between nearest neighbours: %.3f"%matchval)
+
+        report.stage('offset')
+        if truth is not None:
+            # And now computing and applying offsets...
+            print('\nDetermining position offset between clustered craters and truth')
+            offset = find_offset(truth, crater_mean_for_comparison)
+            crater_mean_for_comparison = apply_offset(crater_mean_for_comparison, offset)
+            crater_mean = apply_offset(crater_mean, offset)
+            points = apply_offset(points, offset)
+            output_filename_base += '_offset'
+            # Write final offset crater catalogue
+            write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin,
+                             catalogue_format)
+            # Make some plots
+            if plots != 'none':
+                submit_plot(background, plot_craters, points, crater_mean, truth, long_min, long_max, lat_min, lat_max,
+                            output_filename_base, user_weights, crater_score, img=image)
+            if truth is not None:
+                matchval = compare(crater_mean_for_comparison, truth)
+                print("\nMedian metric distance between nearest neighbours after offset: %.3f"%matchval)
+        report.stage(None)
+        if profile:
+            profiler.disable()
+            profiler.dump_stats(report_filename_base + '.prof')
+        report.write(report_filename_base + '_report.json', parameters=parameters, nmarkings=len(points),
+                     nclusters=int(nclusters), ncraters=len(crater_count),
+                     cluster_sizes=size_histogram(cluster_count), crater_sizes=size_histogram(crater_count))
+    finally:
+        _report = None
+        if profile:
+            profiler.disable()
+    
+    # If this is a test we know the true clustering, which can be used to evaluate performance
+    if test:
+        from sklearn import metrics
+        labels_true = points['truelabel']
+        print
+        print("Homogeneity: %0.3f" % metrics.homogeneity_score(labels_true, clusters))
+        print("Completeness: %0.3f" % metrics.completeness_score(labels_true, clusters))
+        print("V-measure: %0.3f" % metrics.v_measure_score(labels_true, clusters))
+        print("Adjusted Rand Index: %0.3f"
+              % metrics.adjusted_rand_score(labels_true, clusters))
+        print("Adjusted Mutual Information: %0.3f"
+              % metrics.adjusted_mutual_info_score(labels_true, clusters))
+    print
+    return crater_count
+    
+
+def read_truth(expert_markings_csv):
+    truth = numpy.genfromtxt(expert_markings_csv, delimiter=',', names=True)
+    if truth.dtype.names[:3] != ('long', 'lat', 'radius'):
+        # this is a cat from Rob, rather than an internal test cat
+        # the format of these files changes every time
+        #truth.dtype.names = ('long', 'lat', 'radius') + truth.dtype.names[3:]
+        truth.dtype.names = ('radius', 'x', 'y', 'long', 'lat')
+        #truth['radius'] /= 2.0  # fix diameter to radius
+        n = len(truth)
+        truth = numpy.rec.fromarrays([truth['long'], truth['lat'], truth['radius'],
+                                      numpy.ones(n, numpy.float), numpy.zeros(n, numpy.float),
+                                      numpy.zeros(n, numpy.float)],
+                                      names=('long', 'lat', 'radius', 'axialratio', 'angle',
+                                             'boulderyness'))
+    return truth
+
+
+class Markings(object):
+    """Markings held as separate columns, rather than as records.
+
+    markings[name] is a column, and markings[index] the Markings with
+    each column indexed.  markings.X is the n by 4 C ordered array of
+    long and lat in radians, radius and minsize, used by the crater
+    metric and clustering.  It is made once, when first needed, and if
+    it has been made, markings[index] takes its rows rather than making
+    it again from the columns.
+    A record array given to Markings is not copied: its columns are
+    kept as views.
+
+    """
+    def __init__(self, columns, names=None):
+        if names is None:
+            names = columns.dtype.names
+        self.names = tuple(names)
+        self.columns = dict((name, numpy.asarray(columns[name])) for name in self.names)
+        self._X = None
+
+    def __len__(self):
+        return len(self.columns[self.names[0]])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.columns[key]
+        markings = Markings(dict((name, column[key]) for name, column in self.columns.items()), self.names)
+        if self._X is not None:
+            markings._X = self._X[key]
+        return markings
+
+    @property
+    def X(self):
+        if self._X is None:
+            X = numpy.empty((len(self), 4), numpy.double)
+            numpy.multiply(self.columns['long'], pi/180.0, X[:,0])
+            numpy.multiply(self.columns['lat'], pi/180.0, X[:,1])
+            X[:,2] = self.columns['radius']
+            X[:,3] = self.columns['minsize']
+            self._X = X
+        return self._X
+
+    def replace(self, **columns):
+        # new Markings sharing all but the given columns
+        new = dict(self.columns)
+        new.update(columns)
+        return Markings(new, self.names)
+
+    def to_records(self):
+        return numpy.rec.fromarrays([self.columns[name] for name in self.names], names=self.names)
+
+    def __getstate__(self):
+        # X is made again if needed, rather than copied to the plotting processes
+        state = dict(self.__dict__)
+        state['_X'] = None
+        return state
+
+
+def as_markings(points):
+    # points, which may be a record array, as Markings
+    return points if isinstance(points, Markings) else Markings(points)
+
+
+def load_markings(moonzoo_markings_csv, region=None):
+    # Markings from a csv file, or the columns of a marking store, not packed into records
+    if is_marking_store(moonzoo_markings_csv):
+        return Markings(read_marking_columns(moonzoo_markings_csv, region=region), marking_names)
+    return Markings(read_markings(moonzoo_markings_csv, region))
+
+
+def select_markings(points, long_min, long_max, lat_min, lat_max, min_user_weight):
+    # Select region of interest and remove markings by users with low weights;
+    # points are only copied if some are removed
     select = (points['long'] >= long_min) & (points['long'] <= long_max)
     select &= (points['lat'] >= lat_min) & (points['lat'] <= lat_max)
     # Get user weights
@@ -156,76 +439,20 @@ def mz_cluster(output_filename_base='mz_clusters', moonzoo_markings_csv='none',
         print('Removing %i of %i markings by users with very low weights'%(user_weights_rejected, select.sum()))
         select &= user_weights_select
     # Filter by user weight
-    points = points[select]
-    user_weights = user_weights[select]
-    smallest_radius = points['radius'].min()
-    smallest_expert_radius = truth['radius'].min() if truth is not None else 0.0
-    if truth is not None:
-        select = (truth['long'] >= long_min) & (truth['long'] <= long_max)
-        select &= (truth['lat'] >= lat_min) & (truth['lat'] <= lat_max)
-        select &= truth['radius'] > smallest_radius  # remove small expert craters
-        truth = truth[select]
-    print('\nNumber of markings: %i'%points.shape[0])
-    print('Radius of smallest marking: %.3f'%smallest_radius)
-    if truth is not None:
-        print('Number of expert markings: %i'%truth.shape[0])
-        print('Radius of smallest expert marking: %.3f'%smallest_expert_radius)
-    # Perform clustering of markings
-    p = numpy.array([points[name] for name in ('long', 'lat', 'radius', 'minsize')], numpy.double)
-    p[0:2] *= pi/180.0
-    clusters = iterative_fastclusterdata(p, threshold, maxcount, mincount, maxiter)
-    # Previous clustering methods:
-    ### clusters = fastclusterdata(p, t=threshold, criterion='distance', method='single')
-    ### clusters = dbscanclusterdata(p, t=threshold, m=mincount)
-    ### clusters = scipy.cluster.hierarchy.fclusterdata(p, t=threshold, criterion='distance', method='single', metric='euclidean')
-    ### clusters = scipy.cluster.hierarchy.fclusterdata(p, t=threshold, criterion='inconsistent', method='single', metric='euclidean')
-    # Calculate clustered crater properties and useful stats
-    # while eliminating clusters with too few markings
-    nclusters = clusters.max()
-    print('\nFound %i initial clusters'%nclusters)
-    crater_mean = numpy.zeros(nclusters, [('long', numpy.float), ('lat', numpy.float), ('radius', numpy.float), ('minsize', numpy.float), ('axialratio', numpy.float), ('angle', numpy.float), ('boulderyness', numpy.float)])
-    crater_stdev = numpy.zeros(nclusters, [('long', numpy.float), ('lat', numpy.float), ('radius', numpy.float), ('minsize', numpy.float), ('axialratio', numpy.float), ('angle', numpy.float), ('boulderyness', numpy.float)])
-    crater_count = numpy.zeros(nclusters, numpy.int)
-    crater_score = numpy.zeros(nclusters, numpy.float)
-    crater_countnotmin = numpy.zeros(nclusters, numpy.int)
-    dra = []
-    drs = []
-    ds = []
-    s = []
-    notmin = []
-    for i in range(nclusters):
-        p = points[clusters == i+1]
-        w = user_weights[clusters == i+1]
-        v = numpy.array([p[name] for name in ('long', 'lat', 'radius', 'minsize', 'axialratio', 'angle', 'boulderyness')], dtype=numpy.double)
-        crater_count[i] = p.shape[0]
-        crater_mean[i] = v.mean(-1)
-        crater_stdev[i] = v.std(-1)
-        minsize = p['minsize'].astype(numpy.bool)
-        notminsize = numpy.logical_not(minsize)
-        crater_score[i] = w[notminsize].sum() + (minsize_factor * w[minsize]).sum()
-        crater_countnotmin[i] = notminsize.sum()
-        if crater_countnotmin[i] > 0:
-            crater_mean['radius'][i] = p['radius'][notminsize].mean()
-            crater_stdev['radius'][i] = p['radius'][notminsize].std()
-            crater_mean['axialratio'][i] = p['axialratio'][notminsize].mean()
-            crater_stdev['axialratio'][i] = p['axialratio'][notminsize].std()
-            crater_mean['angle'][i] = p['angle'][notminsize].mean()
-            crater_stdev['angle'][i] = p['angle'][notminsize].std()
-        bouldery = p['boulderyness'] > 0
-        if bouldery.sum() > 0:
-            crater_mean['boulderyness'][i] = p['boulderyness'][bouldery].mean()
-            crater_stdev['boulderyness'][i] = p['boulderyness'][bouldery].std()
-        if crater_count[i] >= mincount:
-            crater_mean['minsize'][i] = 0
-            m = numpy.array([crater_mean[name][i] for name in ('long', 'lat', 'radius', 'minsize')], numpy.double)
-            v[0:2] *= pi/180.0
-            m[0:2] *= pi/180.0
-            dra.extend(crater_absolute_position_metric(m, v.T))
-            drs.extend(crater_position_metric(m, v.T))
-            ds.extend(crater_size_metric(m, v.T))
-            s.extend([crater_mean['radius'][i]]*crater_count[i])
-            notmin.extend(notminsize)
-    dra, drs, ds, s, notmin = map(numpy.array, (dra, drs, ds, s, notmin))
+    if not select.all():
+        points = points[select]
+        user_weights = user_weights[select]
+    return points, user_weights
+
+
+def select_truth(truth, long_min, long_max, lat_min, lat_max, smallest_radius):
+    select = (truth['long'] >= long_min) & (truth['long'] <= long_max)
+    select &= (truth['lat'] >= lat_min) & (truth['lat'] <= lat_max)
+    select &= truth['radius'] > smallest_radius  # remove small expert craters
+    return truth[select]
+
+
+def select_craters(crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin, mincount):
     # select final craters exceeding specified score
     # also reject craters with one or fewer notmin markings
     ok = (crater_score >= mincount) & (crater_countnotmin > 1)
@@ -236,143 +463,255 @@ def mz_cluster(output_filename_base='mz_clusters', moonzoo_markings_csv='none',
     crater_stdev = crater_stdev[ok]
     crater_mean = crater_mean[['long', 'lat', 'radius', 'axialratio', 'angle', 'boulderyness']]
     crater_stdev = crater_stdev[['long', 'lat', 'radius', 'axialratio', 'angle', 'boulderyness']]
-    print('Found %i final clusters'%len(crater_count))
+    return crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin
 
-    crater_mean_for_comparison = crater_mean[crater_mean['radius'] > smallest_expert_radius]
-    print('Only computing stats for set of %i craters larger than smallest truth crater'%len(crater_mean_for_comparison))
 
-    # Write final crater catalogue to a csv file
-    write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin)
-    # Make some plots
-    plot_cluster_stats(dra, drs, ds, s, notmin, output_filename_base)
-    plot_crater_stats(crater_mean_for_comparison, truth, output_filename_base)
-    plot_cluster_diagnostics(points, crater_mean, truth, long_min, long_max, lat_min, lat_max, output_filename_base)
-    plot_craters(points, crater_mean, truth, long_min, long_max, lat_min, lat_max, output_filename_base, user_weights, crater_score, img=image)
-    if len(nac_names) > 0 and nac_names != 'NONE':
-        plot_coverage(long_min, long_max, lat_min, lat_max, output_filename_base, nac_names=nac_names, img=image)
+def aggregate_clusters(points, user_weights, clusters, mincount):
+    """Calculate the properties of every cluster in one pass.
 
-    if truth is not None:
-        matchval = compare(crater_mean_for_comparison, truth)
-        print("\nMedian metric distance between nearest neighbours: %.3f"%matchval)
+    Markings are grouped by cluster label using bincount, rather than
+    selecting each cluster in turn.  Radius, axial ratio and angle are
+    averaged over the markings that are not minimum size, if there are
+    any, and boulderyness over the bouldery markings, if there are any.
+    For clusters with at least mincount markings, the distances of each
+    marking from its cluster mean are also returned, grouped by cluster.
+
+    """
+    names = ('long', 'lat', 'radius', 'minsize', 'axialratio', 'angle', 'boulderyness')
+    points = as_markings(points)
+    nclusters = clusters.max()
+    labels = clusters - 1
+    crater_mean = numpy.zeros(nclusters, [(name, numpy.float) for name in names])
+    crater_stdev = numpy.zeros(nclusters, [(name, numpy.float) for name in names])
+    crater_count = numpy.bincount(labels, minlength=nclusters)
+    minsize = points['minsize'].astype(numpy.bool)
+    notminsize = numpy.logical_not(minsize)
+    bouldery = points['boulderyness'] > 0
+    crater_countnotmin = numpy.bincount(labels[notminsize], minlength=nclusters)
+    countbouldery = numpy.bincount(labels[bouldery], minlength=nclusters)
+    w = numpy.where(minsize, minsize_factor, 1.0) * user_weights
+    crater_score = numpy.bincount(labels, w, minlength=nclusters)
+    for name in names:
+        x = numpy.asarray(points[name], numpy.double)
+        crater_mean[name], crater_stdev[name] = group_mean_stdev(x, labels, crater_count)
+    for name, subset, nsubset in (('radius', notminsize, crater_countnotmin),
+                                  ('axialratio', notminsize, crater_countnotmin),
+                                  ('angle', notminsize, crater_countnotmin),
+                                  ('boulderyness', bouldery, countbouldery)):
+        ok = nsubset > 0
+        x = numpy.asarray(points[name][subset], numpy.double)
+        mean, stdev = group_mean_stdev(x, labels[subset], nsubset)
+        crater_mean[name][ok] = mean[ok]
+        crater_stdev[name][ok] = stdev[ok]
+    big = crater_count >= mincount
+    crater_mean['minsize'][big] = 0
+    # distances of markings from their cluster means, in cluster order
+    order = numpy.argsort(clusters, kind='mergesort')
+    order = order[big[labels[order]]]
+    M = numpy.column_stack([crater_mean[name] for name in ('long', 'lat', 'radius', 'minsize')])
+    M[:,0:2] *= pi/180.0
+    dra, drs, ds = crater_pair_components(M[labels[order]], points.X[order])
+    s = crater_mean['radius'][labels[order]]
+    notmin = notminsize[order]
+    return crater_mean, crater_stdev, crater_count, crater_score, crater_countnotmin, dra, drs, ds, s, notmin
+
+
+def group_mean_stdev(x, labels, count):
+    # mean and standard deviation of x within each group, zero for empty groups
+    n = numpy.maximum(count, 1)
+    mean = numpy.bincount(labels, x, minlength=len(count)) / n
+    dev = x - mean[labels]
+    stdev = numpy.sqrt(numpy.bincount(labels, dev*dev, minlength=len(count)) / n)
+    return mean, stdev
+
+
+def write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin,
+                     format='csv'):
+    # format is one of mz_catalogue.catalogue_writers, 'csv' or 'npy'
+    cat = make_crater_cat(crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin)
+    catalogue_writers[format](crater_cat_filename(output_filename_base, format), cat)
 
-    if truth is not None:
-        # And now computing and applying offsets...
-        print('\nDetermining position offset between clustered craters and truth')
-        offset = find_offset(truth, crater_mean_for_comparison)
-        crater_mean_for_comparison = apply_offset(crater_mean_for_comparison, offset)
-        crater_mean = apply_offset(crater_mean, offset)
-        points = apply_offset(points, offset)
-        output_filename_base += '_offset'
-        # Write final offset crater catalogue to a csv file
-        write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin)
-        # Make some plots
-        plot_craters(points, crater_mean, truth, long_min, long_max, lat_min, lat_max, output_filename_base,
-                     user_weights, crater_score, img=image)
-        if truth is not None:
-            matchval = compare(crater_mean_for_comparison, truth)
-            print("\nMedian metric distance between nearest neighbours after offset: %.3f"%matchval)
-    
-    # If this is a test we know the true clustering, which can be used to evaluate performance
-    if test:
-        from sklearn import metrics
-        labels_true = points['truelabel']
-        print
-        print("Homogeneity: %0.3f" % metrics.homogeneity_score(labels_true, clusters))
-        print("Completeness: %0.3f" % metrics.completeness_score(labels_true, clusters))
-        print("V-measure: %0.3f" % metrics.v_measure_score(labels_true, clusters))
-        print("Adjusted Rand Index: %0.3f"
-              % metrics.adjusted_rand_score(labels_true, clusters))
-        print("Adjusted Mutual Information: %0.3f"
-              % metrics.adjusted_mutual_info_score(labels_true, clusters))
-    print
-    return crater_count
     
+def get_db(db='moonzoo'):
+    # one connection per database and process, kept open and reconnected if it drops
+    key = (os.getpid(), db)
+    if key in _db_connections:
+        connection = _db_connections[key]
+        connection.ping(reconnect=True)
+    else:
+        connection = pymysql.connect(host="localhost", user="root", passwd="", db=db)
+        _db_connections[key] = connection
+    return connection
 
-def write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin):
-    fout = open(output_filename_base+'_craters.csv', 'w')
-    fout.write('long,long_std,lat,lat_std,radius,radius_std,axialratio,axialratio_std,angle,angle_std,boulderyness,boulderyness_std,score,count,countnotmin\n')
-    outarray = numpy.zeros((15, crater_mean.shape[0]), numpy.float)
-    outarray[:-3:2] = [crater_mean[n] for n in crater_mean.dtype.names]
-    outarray[1:-3:2] = [crater_stdev[n] for n in crater_stdev.dtype.names]
-    outarray[-3] = crater_score
-    outarray[-2] = crater_count
-    outarray[-1] = crater_countnotmin
-    numpy.savetxt(fout, outarray.T, delimiter=", ", fmt='%.6f')
-    fout.close()
 
-    
 def get_user_weights(userids, db='moonzoo'):
+    """Weights of the users with the given ids, from the user_weights table.
+
+    Weights are cached on disk, in user_weights_cache, as sorted arrays
+    of ids and weights, which are discarded whenever the checksum of the
+    table changes.  Only the distinct ids missing from the cache are
+    fetched from the database.  Users without a weight in the table are
+    given unknown_user_weight.
+
+    """
     if (userids == 0).all():
         return numpy.ones(len(userids), numpy.float)
-    else:
-        db = pymysql.connect(host="localhost", user="root", passwd="", db=db)
-        cur = db.cursor() 
-        sql = """SELECT zooniverse_user_id, weight
-                 FROM user_weights"""
-        cur.execute(sql)
-        data = numpy.rec.fromrecords(cur.fetchall())
-        db.close()
-        match = matchids(data['f0'], userids.astype(numpy.int))
-        return data['f1'][match].astype(numpy.float)
+    userids = userids.astype(numpy.int)
+    cur = get_db(db).cursor()
+    cur.execute("CHECKSUM TABLE user_weights")
+    checksum = int(cur.fetchone()[1])
+    cache = read_user_weights_cache(db, checksum)
+    ids = numpy.unique(userids)
+    new = numpy.setdiff1d(ids, cache['id'], assume_unique=True)
+    if len(new) > 0:
+        weights = numpy.zeros(len(new), numpy.float) + numpy.nan
+        for k in range(0, len(new), 10000):
+            chunk = new[k:k+10000]
+            sql = """SELECT zooniverse_user_id, weight
+                     FROM user_weights
+                     WHERE zooniverse_user_id IN (%s)"""%','.join(['%s']*len(chunk))
+            cur.execute(sql, tuple(int(i) for i in chunk))
+            rows = cur.fetchall()
+            if len(rows) > 0:
+                found, weight = numpy.array(rows, numpy.float).T
+                weights[numpy.searchsorted(new, found.astype(numpy.int))] = weight
+        cache = numpy.concatenate((cache, numpy.rec.fromarrays([new, weights], dtype=cache.dtype)))
+        cache.sort(order='id')
+        write_user_weights_cache(db, checksum, cache)
+    cur.close()
+    weights = cache['weight'][matchids(cache['id'], userids)]
+    weights[numpy.isnan(weights)] = unknown_user_weight
+    return weights
+
+
+def read_user_weights_cache(db, checksum):
+    filename = os.path.join(user_weights_cache, '%s.npz'%db)
+    empty = numpy.zeros(0, [('id', numpy.int), ('weight', numpy.float)]).view(numpy.recarray)
+    if not os.path.exists(filename):
+        return empty
+    cache = numpy.load(filename)
+    if int(cache['checksum']) != checksum:
+        return empty
+    return numpy.rec.fromarrays([cache['id'], cache['weight']], dtype=empty.dtype)
+
+
+def write_user_weights_cache(db, checksum, cache):
+    if not os.path.isdir(user_weights_cache):
+        os.makedirs(user_weights_cache)
+    filename = os.path.join(user_weights_cache, '%s.npz'%db)
+    # write then rename, so that other processes never read part of a file
+    tmp = filename + '.%i.tmp.npz'%os.getpid()
+    numpy.savez(tmp, checksum=checksum, id=cache['id'], weight=cache['weight'])
+    os.rename(tmp, filename)
     
 
 def draw_craters(points, c='r', lw=1, ls='solid', alpha=0.5):
-    if not isinstance(lw, Container):
-        lw = numpy.zeros(len(points)) + lw
+    # all craters are drawn as a single collection, rather than an artist
+    # each, with linewidths given per crater if lw is an array.
+    # Writing many thousands of ellipses to a pdf is still slow, so large
+    # collections are rasterized, at the resolution of the saved figure.
     ax = pyplot.gcf().gca()
-    for i, p in enumerate(points):
-        x, y, r, q, theta, b = [p[name] for name in ['long', 'lat', 'radius', 'axialratio', 'angle', 'boulderyness']]
-        crater = Ellipse((x, y), width=2*r*degrees_per_metre, height=2*q*r*degrees_per_metre, angle=theta,
-                         color=c, fill=False, lw=lw[i], ls=ls, alpha=alpha)
-        ax.add_artist(crater)
+    r = points['radius'] * degrees_per_metre
+    offsets = numpy.column_stack((points['long'], points['lat']))
+    craters = EllipseCollection(2*r, 2*points['axialratio']*r, points['angle'], units='xy',
+                                offsets=offsets, transOffset=ax.transData,
+                                facecolors='none', edgecolors=c, linewidths=lw, linestyles=ls, alpha=alpha)
+    craters.set_rasterized(len(points) > max_vector_craters)
+    ax.add_collection(craters, autolim=False)
     pyplot.xlabel('long')
     pyplot.ylabel('lat')
     
 
-def make_test_craters(ncraters=10, nobs=10, pmin=0.1, pwrong=0.15):
+def make_test_craters(ncraters=10, nobs=10, pmin=0.1, pwrong=0.15, seed=None,
+                      markings_filename='testcraters.csv', truth_filename='truthcraters.csv'):
+    """Make a synthetic set of craters, and markings of them by nobs observers.
+
+    Each observer marks every crater, with a position scatter of the
+    square root of its radius and a radius scatter of a fifth of it.
+    A fraction pwrong of markings are placed at random instead, and a
+    fraction pmin are given the minimum size.  The markings are made and
+    written one observer at a time, to a csv file, or to a marking store
+    (see mz_markings.py) if markings_filename does not end in '.csv', so
+    only the craters and one observer's markings are held in memory.
+    The truth catalogue is written to truth_filename.
+
+    Each observer's markings come from a random number generator seeded
+    with (seed, observer), so the same seed always gives the same files.
+    If seed is None, it is drawn from numpy.random.
+
+    """
+    if seed is None:
+        seed = numpy.random.randint(2**31)
+    rng = numpy.random.RandomState(seed)
     scale = numpy.sqrt(ncraters/10.0) * 100
     # true craters
-    cx = numpy.random.normal(scale*4, scale*2, size=ncraters)
-    cy = numpy.random.normal(scale*4, scale*2, size=ncraters)
-    cr = numpy.random.uniform(7.4, scale/3.0, size=ncraters)
-    # test craters
-    x = numpy.zeros(ncraters*nobs, numpy.float)
-    y = numpy.zeros(ncraters*nobs, numpy.float)
-    r = numpy.zeros(ncraters*nobs, numpy.float)
-    truelabel = numpy.zeros(ncraters*nobs, numpy.int)
-    flag = numpy.zeros(ncraters*nobs, numpy.int)
-    for i in range(nobs):
-        x[i*ncraters:(i+1)*ncraters] = numpy.random.normal(cx, numpy.sqrt(cr)/1.0)
-        y[i*ncraters:(i+1)*ncraters] = numpy.random.normal(cy, numpy.sqrt(cr)/1.0)
-        r[i*ncraters:(i+1)*ncraters] = numpy.maximum(numpy.random.normal(cr, cr/5.0), 7.4)
-        truelabel[i*ncraters:(i+1)*ncraters] = numpy.arange(ncraters)+1
-        for j in range(ncraters):
-            # some of the time get the position completely wrong
-            if numpy.random.random() < pwrong:
-                x[i*ncraters+j], y[i*ncraters+j] = numpy.random.normal(scale*4, scale*2, size=2)
-                flag[i*ncraters+j] = 0
-                truelabel[i*ncraters+j] = 0
-            # some of the time set the crater to a minimum size
-            if numpy.random.random() < pmin:
-                r[i*ncraters+j] = 7.4
-                flag[i*ncraters+j] = 1
-    # convert x,y in metres into long,lat
-    x, y, cx, cy = numpy.multiply((x, y, cx, cy), degrees_per_metre)
+    cx = rng.normal(scale*4, scale*2, size=ncraters)
+    cy = rng.normal(scale*4, scale*2, size=ncraters)
+    cr = rng.uniform(7.4, scale/3.0, size=ncraters)
     offset = 0.001
-    f = file('truthcraters.csv', 'w')
+    truth = numpy.array([cx*degrees_per_metre+offset, cy*degrees_per_metre+offset, cr,
+                         numpy.ones(ncraters), numpy.zeros(ncraters), numpy.zeros(ncraters)]).T
+    f = file(truth_filename, 'w')
     f.write('long,lat,radius,axialratio,angle,boulderyness\n')
-    for i in range(len(cx)):
-        f.write('%f,%f,%f,%f,%f,%i\n'%(cx[i]+offset, cy[i]+offset, cr[i], 1.0, 0.0, 0))
-    f.close()        
-    f = file('testcraters.csv', 'w')
-    f.write('long,lat,radius,axialratio,angle,boulderyness,minsize,user,truelabel\n')
-    for i in range(len(x)):
-        f.write('%f,%f,%f,%i,%f,%f,%i,%i,%i\n'%(x[i], y[i], r[i], 1.0, 0.0, 0, flag[i], 0, truelabel[i]))
-    f.close()        
-    #numpy.savetxt("testcraters.csv", p.transpose(), delimiter=",")
+    write_rows(f, truth, '%f,%f,%f,%f,%f,%i\n')
+    f.close()
+    if markings_filename.endswith('.csv'):
+        f = file(markings_filename, 'w')
+        f.write('long,lat,radius,axialratio,angle,boulderyness,minsize,user,truelabel\n')
+    else:
+        store = create_marking_store(markings_filename, ncraters*nobs,
+                                     marking_columns + (('truelabel', numpy.int64),))
+    for i in range(nobs):
+        # test craters
+        obs_rng = numpy.random.RandomState((seed, i))
+        x = obs_rng.normal(cx, numpy.sqrt(cr))
+        y = obs_rng.normal(cy, numpy.sqrt(cr))
+        r = numpy.maximum(obs_rng.normal(cr, cr/5.0), 7.4)
+        truelabel = numpy.arange(1, ncraters+1)
+        # some of the time get the position completely wrong
+        wrong = numpy.flatnonzero(obs_rng.random_sample(ncraters) < pwrong)
+        x[wrong] = obs_rng.normal(scale*4, scale*2, size=len(wrong))
+        y[wrong] = obs_rng.normal(scale*4, scale*2, size=len(wrong))
+        truelabel[wrong] = 0
+        # some of the time set the crater to a minimum size
+        flag = obs_rng.random_sample(ncraters) < pmin
+        r[flag] = 7.4
+        # convert x,y in metres into long,lat
+        x, y = numpy.multiply((x, y), degrees_per_metre)
+        zeros = numpy.zeros(ncraters)
+        if markings_filename.endswith('.csv'):
+            write_rows(f, numpy.array([x, y, r, zeros+1, zeros, zeros, flag, zeros, truelabel]).T,
+                       '%f,%f,%f,%i,%f,%f,%i,%i,%i\n')
+        else:
+            rows = slice(i*ncraters, (i+1)*ncraters)
+            columns = (x, y, r, zeros+1, zeros, zeros, flag, zeros, truelabel)
+            for name, column in zip(marking_names + ('truelabel',), columns):
+                store[name][rows] = column
+    if markings_filename.endswith('.csv'):
+        f.close()
+    else:
+        for column in store.values():
+            column.flush()
 
     
-def find_offset(p1, p2):
+def write_rows(f, rows, fmt, nrows=10000):
+    # as numpy.savetxt, but formatting nrows rows at a time, which is much faster
+    for start in range(0, len(rows), nrows):
+        chunk = rows[start:start+nrows]
+        f.write((fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def find_offset(p1, p2, max_shift=None, ngrid=9, nlevels=3):
+    """Find the shift of p2, in degrees of long and lat, that best matches p1.
+
+    The mean crater_metric distance from each crater in the smaller
+    catalogue to its nearest neighbour in the larger, as comparedata, is
+    minimised.  The larger catalogue is indexed with a KD-tree once.  A
+    grid of ngrid x ngrid shifts within max_shift (in rough metres,
+    default twice the median radius) is searched, then nlevels-1 finer
+    grids around the best so far, before a final local minimisation.
+
+    """
     datarange = (p1['long'].min(), p1['long'].min(), p1['long'].max(), p1['lat'].min(), p1['lat'].max())    
     long_min = max(p1['long'].min(), p2['long'].min())
     long_max = min(p1['long'].max(), p2['long'].max())
@@ -394,13 +733,33 @@ def find_offset(p1, p2):
     minsize2 = numpy.zeros(p2.shape[0], [('minsize', numpy.double)])
     X1 = numpy.asarray([p1[name] for name in ('long', 'lat', 'radius')]+[minsize1['minsize']], order='c', dtype=numpy.double)
     X2 = numpy.asarray([p2[name] for name in ('long', 'lat', 'radius')]+[minsize2['minsize']], order='c', dtype=numpy.double)
-    results = fmin(comparedata, [0.0, 0.0], args=(X1, X2), xtol=0.001, maxiter=1000)
+    # index the larger catalogue, as comparedata takes minima along the longer axis,
+    # and shift the smaller one the opposite way if it is p1
+    if X1.shape[1] >= X2.shape[1]:
+        Xref, Xshift, sign = X1.T.copy(), X2.T.copy(), 1.0
+    else:
+        Xref, Xshift, sign = X2.T.copy(), X1.T.copy(), -1.0
+    tree = cKDTree(crater_unit_vectors(Xref))
+    if max_shift is None:
+        max_shift = 2 * numpy.median(Xshift[:,2])
+    shift = numpy.zeros(2)
+    width = max_shift
+    for level in range(nlevels):
+        grid = numpy.linspace(-width, width, ngrid)
+        shifts = [shift + (dx, dy) for dx in grid for dy in grid]
+        values = [offsetdata(s, tree, Xref, Xshift, sign) for s in shifts]
+        shift = shifts[numpy.argmin(values)]
+        width = grid[1] - grid[0]
+    results = fmin(offsetdata, shift, args=(tree, Xref, Xshift, sign), xtol=0.001, maxiter=1000)
     results *= degrees_per_metre  # convert from rough metres to degrees
     print('Found a shift of dlong = %e deg, dlat = %e deg'%tuple(results))
     return results
 
 
 def apply_offset(p, offset):
+    if isinstance(p, Markings):
+        # only the positions are copied
+        return p.replace(long=p['long'] + offset[0], lat=p['lat'] + offset[1])
     pnew = p.copy()
     pnew['long'] += offset[0]
     pnew['lat'] += offset[1]
@@ -412,7 +771,20 @@ def compare(p1, p2):
     minsize2 = numpy.zeros(p2.shape[0], [('minsize', numpy.double)])
     X1 = numpy.asarray([p1[name] for name in ('long', 'lat', 'radius')]+[minsize1['minsize']], order='c', dtype=numpy.double)
     X2 = numpy.asarray([p2[name] for name in ('long', 'lat', 'radius')]+[minsize2['minsize']], order='c', dtype=numpy.double)
-    return comparedata(numpy.array([0.0, 0.0]), X1, X2)
+    # comparedata without a shift, indexing the larger catalogue rather than
+    # finding the distances between every pair
+    if X1.shape[1] >= X2.shape[1]:
+        Xref, X = X1.T.copy(), X2.T.copy()
+    else:
+        Xref, X = X2.T.copy(), X1.T.copy()
+    return numpy.mean(crater_nearest(cKDTree(crater_unit_vectors(Xref)), Xref, X))
+
+
+def offsetdata(shift, tree, Xref, Xshift, sign):
+    # comparedata, with the larger catalogue Xref indexed by tree
+    X = Xshift.copy()
+    X[:,:2] += sign * numpy.asarray(shift) * degrees_per_metre
+    return numpy.mean(crater_nearest(tree, Xref, X))
 
 
 def comparedata(shift, X1, X2):
@@ -432,7 +804,22 @@ def comparedata(shift, X1, X2):
 def fastclusterdata(X, t, criterion='distance', method='single'):
     """
     scipy.cluster.hierarchy.fclusterdata modified to use fastcluster
+
+    X may also be a sparse graph of crater_metric distances, such as
+    from crater_pdist_sparse, in which case only single linkage is
+    possible.  For the 'distance' criterion the clusters are then the
+    connected components of the pairs within t, otherwise the linkage
+    is built from the minimum spanning tree of the graph.
     """
+    if scipy.sparse.issparse(X):
+        if method != 'single':
+            raise ValueError('Only single linkage is possible with a sparse '
+                             'distance graph.')
+        if criterion == 'distance':
+            return graphclusters(X, t)
+        Z = sparse_single_linkage(X)
+        return scipy.cluster.hierarchy.fcluster(Z, criterion=criterion, t=t)
+
     X = numpy.asarray(X, order='c', dtype=numpy.double)
 
     if type(X) != numpy.ndarray or len(X.shape) != 2:
@@ -447,64 +834,667 @@ def fastclusterdata(X, t, criterion='distance', method='single'):
     return T
 
 
-def dbscanclusterdata(X, t, m):
+def graphclusters(G, t):
+    # connected components of the pairs in a sparse distance graph within
+    # t of each other, labelled in order of their first member
+    G = scipy.sparse.coo_matrix(G)
+    keep = G.data <= t
+    G = scipy.sparse.coo_matrix((G.data[keep], (G.row[keep], G.col[keep])), shape=G.shape)
+    ncomponents, T = connected_components(G, directed=False)
+    return T + 1
+
+
+def sparse_single_linkage(G):
     """
-    Attempt at using sklearn.DBSCAN - but no faster than fastcluster
+    Single linkage matrix, in the form of fastcluster.linkage, from the
+    minimum spanning tree of a sparse distance graph.  Pairs missing
+    from the graph are treated as infinitely distant.
     """
-    from sklearn.cluster import DBSCAN
+    n = G.shape[0]
+    mst = scipy.sparse.coo_matrix(minimum_spanning_tree(G))
+    order = numpy.argsort(mst.data, kind='mergesort')
+    a = list(mst.row[order])
+    b = list(mst.col[order])
+    h = list(mst.data[order])
+    # join any separate components, in order of their first members
+    ncomponents, components = connected_components(G, directed=False)
+    first = numpy.unique(components, return_index=True)[1]
+    a.extend([first[0]] * (ncomponents - 1))
+    b.extend(first[1:])
+    h.extend([numpy.inf] * (ncomponents - 1))
+    # merge clusters in order of increasing distance
+    parent = range(2*n - 1)
+    size = [1] * (2*n - 1)
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    Z = numpy.zeros((n - 1, 4), numpy.double)
+    for k in range(n - 1):
+        i, j = root(a[k]), root(b[k])
+        Z[k] = (min(i, j), max(i, j), h[k], size[i] + size[j])
+        parent[i] = parent[j] = n + k
+        size[n + k] = size[i] + size[j]
+    return Z
+
+
+def graph_mst_edges(G, t):
+    # links of the minimum spanning forest of a sparse distance graph
+    # that are no longer than t, as arrays of (i, j, distance)
+    mst = scipy.sparse.coo_matrix(minimum_spanning_tree(G))
+    keep = mst.data <= t
+    i = numpy.minimum(mst.row, mst.col)[keep]
+    j = numpy.maximum(mst.row, mst.col)[keep]
+    return i, j, mst.data[keep]
+
+
+def linkage_edges(Z, t):
+    # links equivalent to a single linkage matrix, joining one member
+    # of each of the merged clusters, for merges no higher than t
+    n = Z.shape[0] + 1
+    member = numpy.concatenate((numpy.arange(n), numpy.zeros(n-1, numpy.int)))
+    for k in range(n-1):
+        member[n+k] = member[int(Z[k,0])]
+    keep = Z[:,2] <= t
+    i = member[Z[keep,0].astype(numpy.int)]
+    j = member[Z[keep,1].astype(numpy.int)]
+    return numpy.minimum(i, j), numpy.maximum(i, j), Z[keep,2]
+
+
+def linkclusterdata(X, t, engine='tree', nprocs=None):
+    """
+    Single linkage clusters of X cut at distance t, using the given
+    engine, together with the links of its single linkage tree no longer
+    than t.  Cutting those links at any lower distance, with edgeclusters,
+    gives the same clusters as clustering again at that distance.
+    """
+    if engine == 'tiled':
+        return tiledclusterdata(X, t, nprocs=nprocs, return_edges=True)
+    elif engine == 'tree':
+        return treeclusterdata(X, t, return_edges=True)
+    elif engine == 'banded':
+        return bandedclusterdata(X, t, return_edges=True)
+    elif engine == 'sparse':
+        G = crater_pdist_sparse(X, t)
+        return graphclusters(G, t), graph_mst_edges(G, t)
+    else:
+        X = numpy.asarray(X, order='c', dtype=numpy.double)
+        Z = fastcluster.linkage(crater_pdist(X), method='single')
+        T = scipy.cluster.hierarchy.fcluster(Z, criterion='distance', t=t)
+        return T, linkage_edges(Z, t)
+
+
+def edgeclusters(n, edges, t):
+    # clusters of n markings joined by the links no longer than t,
+    # labelled in order of their first member
+    i, j, h = edges
+    keep = h <= t
+    G = scipy.sparse.coo_matrix((numpy.ones(keep.sum()), (i[keep], j[keep])), shape=(n, n))
+    ncomponents, T = connected_components(G, directed=False)
+    return T + 1
+
+
+def split_edges(subclusters, edges, t):
+    # links no longer than t within each subcluster, renumbered to the
+    # positions of the markings within their subcluster
+    i, j, h = edges
+    keep = h <= t
+    i, j, h = i[keep], j[keep], h[keep]
+    nsubclusters = subclusters.max()
+    counts = numpy.bincount(subclusters, minlength=nsubclusters+1)[1:]
+    order = numpy.argsort(subclusters, kind='mergesort')
+    position = numpy.zeros(len(subclusters), numpy.int)
+    position[order] = numpy.arange(len(subclusters)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    label = subclusters[i]
+    order = numpy.argsort(label, kind='mergesort')
+    bounds = numpy.cumsum(numpy.bincount(label, minlength=nsubclusters+1)[1:])[:-1]
+    i, j, h = position[i[order]], position[j[order]], h[order]
+    return zip(numpy.split(i, bounds), numpy.split(j, bounds), numpy.split(h, bounds))
+
+
+def treeclusterdata(X, t, return_edges=False):
+    """
+    Single linkage clustering, cut at distance t, without a distance matrix.
+
+    Only pairs of markings within crater_metric t of each other are found,
+    using a KD-tree, and the flat clusters are the connected components
+    of that graph.  This gives the same clusters as fastclusterdata with
+    criterion='distance', labelled in order of their first member.
 
+    If return_edges is True, the edges of the minimum spanning forest of
+    the graph are also returned, see linkclusterdata.
+    """
     X = numpy.asarray(X, order='c', dtype=numpy.double)
 
     if type(X) != numpy.ndarray or len(X.shape) != 2:
         raise TypeError('The observation matrix X must be an n by m numpy '
                         'array.')
 
-    db = DBSCAN(eps=t, min_samples=m, metric=crater_metric).fit(X)
+    G = crater_neighbour_graph(X, t)
+    T = graphclusters(G, t)
+    if return_edges:
+        return T, graph_mst_edges(G, t)
+    return T
+
+
+def tiledclusterdata(X, t, nprocs=None, ntiles=None, min_tile_points=10000, return_edges=False):
+    """
+    treeclusterdata split into overlapping tiles clustered in parallel.
+
+    The region is cut into strips of equal numbers of markings along its
+    longer axis.  Each strip is extended by a halo wide enough to contain
+    every marking that any of its own markings could link to, given the
+    largest marking radius, so every link is found in at least one tile.
+    Tile clusters that share a marking are then merged, which gives
+    exactly the labels of a single treeclusterdata run.  The minimum
+    spanning forest of all the markings, if return_edges is True, is
+    that of the union of the tiles' forests.
+    """
+    X = numpy.asarray(X, order='c', dtype=numpy.double)
+
+    if type(X) != numpy.ndarray or len(X.shape) != 2:
+        raise TypeError('The observation matrix X must be an n by m numpy '
+                        'array.')
+
+    n = X.shape[0]
+    if nprocs is None:
+        nprocs = cpu_count()
+    if ntiles is None:
+        ntiles = 4 * nprocs
+    ntiles = min(ntiles, n // min_tile_points)
+    if ntiles <= 1:
+        return treeclusterdata(X, t, return_edges)
+    # maximum angular separation of any linked pair
+    theta = t * crater_metrics.pscale * X[:,2].max() / lunar_radius
+    halo_lat = theta * (1 + 1e-9)
+    cos_lat = numpy.cos(numpy.abs(X[:,1]).max())
+    if cos_lat > numpy.sin(theta/2.0):
+        halo_long = 2 * numpy.arcsin(numpy.sin(theta/2.0) / cos_lat) * (1 + 1e-9)
+    else:
+        halo_long = 2*pi
+    long_extent = numpy.ptp(X[:,0]) * numpy.cos(numpy.median(X[:,1]))
+    if long_extent > numpy.ptp(X[:,1]):
+        axis, halo = 0, halo_long
+    else:
+        axis, halo = 1, halo_lat
+    c = X[:,axis]
+    bounds = numpy.percentile(c, numpy.linspace(0, 100, ntiles+1))
+    bounds[-1] = numpy.inf
+    tiles = []
+    for k in range(ntiles):
+        tiles.append(numpy.flatnonzero((c >= bounds[k] - halo) & (c < bounds[k+1] + halo)))
+    print('Clustering %i markings in %i tiles using %i processes'%(n, ntiles, nprocs))
+    pool = Pool(nprocs)
+    try:
+        tile_clusters = pool.map(cluster_tile, ((X[idx], t, crater_metrics.pscale, crater_metrics.sscale)
+                                                for idx in tiles))
+    finally:
+        pool.close()
+        pool.join()
+    T = stitch_tile_clusters(n, tiles, [T for T, edges in tile_clusters])
+    if return_edges:
+        return T, stitch_tile_edges(n, tiles, [edges for T, edges in tile_clusters], t)
+    return T
+
+
+def bandedclusterdata(X, t, return_edges=False, bandwidth=None):
+    """
+    treeclusterdata split into overlapping bands of log radius.
+
+    Two markings that are not minimum size can only be within
+    crater_metric t of each other if the ratio of their radii is no more
+    than (2 + t*sscale) / (2 - t*sscale).  Those markings are split into
+    bands of log radius (of width bandwidth, by default the log of that
+    ratio), each extended upwards by the ratio, so every such pair is in
+    at least one band, and each band is clustered alone, comparing only
+    markings of similar size.  The pairs including a minimum size
+    marking, which may link to a marking of any size, are found
+    separately.  Clusters sharing a marking or joined by one of those
+    pairs are merged, which gives exactly the labels of a single
+    treeclusterdata run.  The minimum spanning forest, if return_edges
+    is True, is that of the union of the bands' forests and those pairs.
+    """
+    X = numpy.asarray(X, order='c', dtype=numpy.double)
+
+    if type(X) != numpy.ndarray or len(X.shape) != 2:
+        raise TypeError('The observation matrix X must be an n by m numpy '
+                        'array.')
+
+    n = X.shape[0]
+    a = t * crater_metrics.sscale
+    if a >= 2 or n < 2:
+        # any sizes may link
+        return treeclusterdata(X, t, return_edges)
+    overlap = numpy.log((2 + a) / (2 - a)) * (1 + 1e-9)
+    if bandwidth is None:
+        bandwidth = overlap
+    minsize = X[:,3] != 0
+    sized = numpy.flatnonzero(~minsize)
+    logs = numpy.log(X[sized,2])
+    order = numpy.argsort(logs, kind='mergesort')
+    sized, logs = sized[order], logs[order]
+    i, j, h = [], [], []
+    if len(sized) > 0:
+        lower = numpy.arange(logs[0], logs[-1] + bandwidth, bandwidth)
+        starts = numpy.searchsorted(logs, lower, 'left')
+        ends = numpy.searchsorted(logs, lower + bandwidth + overlap, 'right')
+        for start, end in zip(starts, ends):
+            if end - start < 2:
+                continue
+            idx = sized[start:end]
+            T, edges = treeclusterdata(X[idx], t, return_edges=True)
+            i.append(idx[edges[0]])
+            j.append(idx[edges[1]])
+            h.append(edges[2])
+        print('Clustered %i markings in %i bands of log radius'%(len(sized), len(starts)))
+    # pairs including a minimum size marking
+    mi, mj, mh = crater_neighbour_pairs_of(X, numpy.flatnonzero(minsize), t)
+    i = numpy.concatenate(i + [numpy.minimum(mi, mj)]).astype(numpy.int)
+    j = numpy.concatenate(j + [numpy.maximum(mi, mj)]).astype(numpy.int)
+    h = numpy.concatenate(h + [mh])
+    # drop links found in more than one band
+    unique = numpy.unique(i * n + j, return_index=True)[1]
+    G = crater_graph(n, i[unique], j[unique], h[unique])
+    T = graphclusters(G, t)
+    if return_edges:
+        return T, graph_mst_edges(G, t)
+    return T
+
+
+def cluster_tile((X, t, pscale, sscale)):
+    crater_metrics.pscale = pscale
+    crater_metrics.sscale = sscale
+    return treeclusterdata(X, t, return_edges=True)
+
+
+def stitch_tile_clusters(n, tiles, tile_clusters):
+    # Join each marking to the clusters containing it in every tile,
+    # then number the merged clusters in order of their first member.
+    offset = n
+    rows = []
+    cols = []
+    for idx, T in zip(tiles, tile_clusters):
+        rows.append(idx)
+        cols.append(T - 1 + offset)
+        offset += T.max() if len(T) > 0 else 0
+    rows = numpy.concatenate(rows)
+    cols = numpy.concatenate(cols)
+    G = scipy.sparse.coo_matrix((numpy.ones(len(rows)), (rows, cols)), shape=(offset, offset))
+    ncomponents, T = connected_components(G, directed=False)
+    return T[:n] + 1
+
+
+def stitch_tile_edges(n, tiles, tile_edges, t):
+    # Any link missing from a tile's spanning forest is the longest link
+    # in some loop within that tile, so it cannot be in the forest of all
+    # the markings, which is therefore the forest of the tiles' links.
+    i = numpy.concatenate([idx[e[0]] for idx, e in zip(tiles, tile_edges)])
+    j = numpy.concatenate([idx[e[1]] for idx, e in zip(tiles, tile_edges)])
+    h = numpy.concatenate([e[2] for e in tile_edges])
+    # drop links found in more than one tile
+    unique = numpy.unique(i * n + j, return_index=True)[1]
+    G = scipy.sparse.coo_matrix((h[unique], (i[unique], j[unique])), shape=(n, n))
+    return graph_mst_edges(G, t)
+
+
+def dbscanclusterdata(X, t, m, engine='tree'):
+    """
+    Density-based clustering with sklearn.DBSCAN, of markings with at
+    least m markings (including themselves) within crater_metric t.
+
+    The graph of all pairs within t is found first, with
+    crater_neighbour_graph for engine 'tree', or crater_pdist_sparse for
+    'sparse', and given to DBSCAN as a precomputed sparse distance
+    matrix, so the metric is never called from Python.  X may also be
+    such a graph already.  Markings that DBSCAN finds are noise are each
+    given a cluster of their own, numbered after the others, so the
+    labels can be used in the same way as those of fastclusterdata.
+    """
+    from sklearn.cluster import DBSCAN
+
+    if not scipy.sparse.issparse(X):
+        X = numpy.asarray(X, order='c', dtype=numpy.double)
+
+        if type(X) != numpy.ndarray or len(X.shape) != 2:
+            raise TypeError('The observation matrix X must be an n by m numpy '
+                            'array.')
+
+        if engine == 'sparse':
+            X = crater_pdist_sparse(X, t)
+        else:
+            X = crater_neighbour_graph(X, t)
+    G = scipy.sparse.csr_matrix(X)
+    G = G + G.T
+    db = DBSCAN(eps=t, min_samples=m, metric='precomputed').fit(G)
     labels = numpy.array(db.labels_, dtype=numpy.int) + 1
+    noise = labels == 0
+    labels[noise] = labels.max() + numpy.arange(1, noise.sum()+1)
     return labels
 
 
-def iterative_fastclusterdata(points, threshold, maxcount, mincount, maxiter):
-    clusters = numpy.ones(points.shape[1], numpy.int)
-    nclusters = 1
+def iterative_fastclusterdata(points, threshold, maxcount, mincount, maxiter, engine='tree', nprocs=None,
+                              edges=None):
+    # Each cluster is kept as an array of its member indices, in increasing
+    # order.  A cluster that is split is replaced by its subclusters at the
+    # end of the list, and labels are only assigned once splitting is done.
+    # The single linkage tree of each subcluster is kept too, so it only
+    # needs to be cut lower when it is split again, as single linkage
+    # clusters at a lower threshold are always subsets of those above.
+    # Clusters cut from a kept tree are numbered in order of first member.
+    # The links of a tree of all the points at a threshold no lower than
+    # the starting one, from linkclusterdata, may be given as edges.
+    # points are markings in columns, as the transpose of Markings.X, so
+    # the markings of a cluster are the rows of X they are taken from.
+    X = points.T
+    members = [numpy.arange(points.shape[1])]
+    links = [edges]
     largeclustersflag = True
     iteration = 0
     while largeclustersflag and iteration < maxiter:
         threshold *= 0.9**iteration
         iteration += 1
         largeclustersflag = False
-        i = 1
-        newclusters = 0
-        while i <= nclusters - newclusters:
-            selectedpoints = clusters == i
-            p = points[:,selectedpoints]
-            if p.shape[1] > maxcount:
+        nbig = sum(len(m) >= mincount for m in members)
+        kept = []
+        keptlinks = []
+        appended = []
+        appendedlinks = []
+        for k, m in enumerate(members):
+            if len(m) > maxcount:
                 if not largeclustersflag:
                     print('\nIteration %i, threshold %.3f'%(iteration, threshold))
-                print('%i clusters, cluster number %i with %i members.'%(nclusters, i, p.shape[1]))
-                subclusters = fastclusterdata(p.transpose(), t=threshold, criterion='distance',
-                                              method='single')
-                nsubclusters = subclusters.max()
-                newclusters += nsubclusters
-                clusters[clusters > i] -= 1
-                clusters[selectedpoints] = subclusters + nclusters - 1
-                nclusters = clusters.max()
+                nclusters = len(kept) + len(members) - k + len(appended)
+                print('%i clusters, cluster number %i with %i members.'%(nclusters, len(kept)+1, len(m)))
+                count_event('clusters_split')
+                if links[k] is None:
+                    count_event('linkage_runs')
+                    p = X if len(m) == len(X) else X[m]
+                    subclusters, edges = linkclusterdata(p, threshold, engine, nprocs)
+                else:
+                    edges = links[k]
+                    subclusters = edgeclusters(len(m), edges, threshold)
+                submembers = split_members(m, subclusters)
+                appended.extend(submembers)
+                appendedlinks.extend(split_edges(subclusters, edges, threshold))
+                nbig += sum(len(sm) >= mincount for sm in submembers) - (len(m) >= mincount)
                 largeclustersflag = True
-                cluster_count = numpy.zeros(nclusters, numpy.int)
-                for j in range(nclusters):
-                    q = points[:,clusters == j+1]
-                    cluster_count[j] = q.shape[1]
-                if nsubclusters > 1:
-                    print('After subclustering, %i clusters, of which %i have at least %i measurements.'%(nclusters, (cluster_count >= mincount).sum(), mincount))
-                    #print('Cluster labels: ' + str(clusters))
-                    #print('Cluster counts: ' + str(cluster_count))
+                if len(submembers) > 1:
+                    nclusters += len(submembers) - 1
+                    print('After subclustering, %i clusters, of which %i have at least %i measurements.'%(nclusters, nbig, mincount))
                 else:
                     print('No change after subclustering')
             else:
-                i += 1
+                kept.append(m)
+                keptlinks.append(links[k])
+        members = kept + appended
+        links = keptlinks + appendedlinks
+        if largeclustersflag:
+            count_event('split_iterations')
+    clusters = numpy.zeros(points.shape[1], numpy.int)
+    sizes = [len(m) for m in members]
+    clusters[numpy.concatenate(members)] = numpy.repeat(numpy.arange(1, len(members)+1), sizes)
     return clusters
 
 
+def split_members(m, subclusters):
+    # member indices of each subcluster, keeping them in increasing order
+    order = numpy.argsort(subclusters, kind='mergesort')
+    bounds = numpy.cumsum(numpy.bincount(subclusters)[1:])[:-1]
+    return numpy.split(m[order], bounds)
+
+
+def mz_cluster_update(output_filename_base, moonzoo_markings_csv, catalogue_format='csv'):
+    """Add new markings to a clustering kept by mz_cluster with save_state=True.
+
+    The markings in moonzoo_markings_csv (a csv file or marking store)
+    must be ones not already clustered.  They are selected with the
+    region and minimum user weight of the saved run, added to the saved
+    clusters with update_clusters, and the crater catalogue and state
+    are written again, unless no markings are selected.  The catalogue
+    has the same craters as clustering all the markings again, with the
+    changed clusters listed last.  Offset catalogues and plots are not
+    remade.
+
+    """
+    state = read_cluster_state(output_filename_base)
+    crater_metrics.pscale = state['position_scale']
+    crater_metrics.sscale = state['size_scale']
+    long_min, long_max, lat_min, lat_max = state['region']
+    points = load_markings(moonzoo_markings_csv, state['region'])
+    points, user_weights = select_markings(points, long_min, long_max, lat_min, lat_max, state['min_user_weight'])
+    print('\nAdding %i markings to %i already clustered'%(len(points), len(state['points'])))
+    if len(points) == 0:
+        # the state and catalogue are left as they are
+        return
+    state = update_clusters(state, points, user_weights)
+    write_cluster_state(output_filename_base, state)
+    crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin = \
+        select_craters(state['crater_mean'], state['crater_stdev'], state['crater_score'],
+                       state['crater_count'], state['crater_countnotmin'], state['mincount'])
+    print('Found %i final clusters'%len(crater_count))
+    write_crater_cat(output_filename_base, crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin,
+                     catalogue_format)
+
+
+def update_clusters(state, points, user_weights):
+    """Add markings to the clustering in state, returning the new state.
+
+    state holds the clustered markings and their user weights, the
+    single linkage components at the starting threshold and the links of
+    their spanning forest, the final cluster labels and the properties
+    of every cluster from aggregate_clusters.  Only the links involving
+    new markings are found.  The components they join, with the new
+    markings, are linked and split again as by iterative_fastclusterdata,
+    and only their clusters are aggregated again.  Other clusters keep
+    their properties, and their labels in the same order, with the
+    changed clusters numbered after them.  The clusters are the same as
+    those from clustering all the markings again.  With no new markings,
+    state is returned unchanged.
+
+    """
+    if len(points) == 0:
+        return state
+    threshold, mincount = state['threshold'], state['mincount']
+    maxcount, maxiter = state['maxcount'], state['maxiter']
+    n = len(state['points'])
+    # the new markings as records like the saved ones, by column name, with
+    # zeros in any columns, like truelabel, that are not marking_names
+    points = as_markings(points)
+    missing = [name for name in marking_names if name not in points.names]
+    if missing:
+        raise ValueError('New markings have no %s column'%', '.join(missing))
+    new = numpy.zeros(len(points), state['points'].dtype)
+    for name in new.dtype.names:
+        if name in points.names:
+            new[name] = points[name]
+    points = numpy.concatenate((state['points'], new))
+    user_weights = numpy.concatenate((state['user_weights'], user_weights))
+    X = Markings(points).X
+    # links from new markings, and the components they join
+    i, j, h = crater_neighbour_pairs_of(X, numpy.arange(n, len(points)), threshold)
+    components = state['components']
+    joined = numpy.unique(components[numpy.concatenate((i[i < n], j[j < n]))])
+    affected = numpy.zeros(len(points), numpy.bool)
+    affected[:n] = numpy.in1d(components, joined)
+    affected[n:] = True
+    members = numpy.flatnonzero(affected)
+    position = numpy.zeros(len(points), numpy.int)
+    position[members] = numpy.arange(len(members))
+    ei, ej, eh = state['edges']
+    ei, ej = ei.astype(numpy.int), ej.astype(numpy.int)
+    inside = affected[ei]
+    G = crater_graph(len(members), position[numpy.concatenate((ei[inside], i))],
+                     position[numpy.concatenate((ej[inside], j))], numpy.concatenate((eh[inside], h)))
+    edges = graph_mst_edges(G, threshold)
+    print('Reclustering %i markings in %i components'%(len(members), len(joined)))
+    # iterative_fastclusterdata keeps up to maxcount markings as one cluster, unsplit
+    subcomponents = edgeclusters(len(members), edges, threshold)
+    if len(members) > maxcount:
+        subclusters = iterative_fastclusterdata(X[members].T, threshold, maxcount, mincount, maxiter,
+                                                edges=edges)
+    else:
+        subclusters = subcomponents
+    components = numpy.concatenate((components, numpy.zeros(len(points) - n, components.dtype)))
+    components[members] = subcomponents + components.max()
+    clusters = numpy.concatenate((state['clusters'], numpy.zeros(len(points) - n, numpy.int)))
+    nclusters = clusters.max()
+    clusters[members] = subclusters + nclusters
+    # number the clusters that remain consecutively, in their previous order
+    present = numpy.zeros(nclusters + subclusters.max() + 1, numpy.bool)
+    present[clusters] = True
+    kept = present[1:nclusters+1]
+    clusters = numpy.cumsum(present)[clusters]
+    new = aggregate_clusters(points[members], user_weights[members], subclusters, mincount)[:5]
+    names = ('crater_mean', 'crater_stdev', 'crater_count', 'crater_score', 'crater_countnotmin')
+    state = dict(state)
+    for name, x in zip(names, new):
+        state[name] = numpy.concatenate((state[name][kept], x))
+    state.update(points=points, user_weights=user_weights, components=components, clusters=clusters,
+                 edges=numpy.array((numpy.concatenate((ei[~inside], members[edges[0]])),
+                                    numpy.concatenate((ej[~inside], members[edges[1]])),
+                                    numpy.concatenate((eh[~inside], edges[2])))))
+    return state
+
+
+def write_cluster_state(output_filename_base, state):
+    filename = output_filename_base + '_state.npz'
+    tmp = filename + '.tmp.npz'
+    numpy.savez(tmp, **state)
+    os.rename(tmp, filename)
+
+
+def read_cluster_state(output_filename_base):
+    # arrays as saved, and the parameters of the run as python numbers
+    f = numpy.load(output_filename_base + '_state.npz')
+    state = dict((name, f[name]) for name in f.files)
+    f.close()
+    for name in ('threshold', 'position_scale', 'size_scale', 'min_user_weight', 'mincount'):
+        state[name] = float(state[name])
+    for name in ('maxcount', 'maxiter'):
+        state[name] = int(state[name])
+    state['region'] = tuple(state['region'])
+    return state
+
+
+class StageReport(object):
+    """The wall time, CPU time and peak memory of the stages of a run.
+
+    stage(name) ends the current stage, if any, and starts the named
+    one; stage(None) just ends it.  A stage that is started again adds
+    to its earlier measurements.  The number of crater_metric pairs
+    evaluated in this process during each stage, from
+    crater_metrics.npairs, is also recorded, and count() keeps named
+    counts of events, such as those from count_event.
+
+    """
+    def __init__(self):
+        self.stages = []
+        self.counts = {}
+        self.current = None
+
+    def stage(self, name):
+        if self.current is not None:
+            wall, times = time.time(), os.times()
+            start_wall, start_times, start_pairs = self.start
+            measured = {'wall': wall - start_wall,
+                        'cpu': round(times[0] + times[1] - start_times[0] - start_times[1], 6) + 0.0,
+                        'cpu_children': round(times[2] + times[3] - start_times[2] - start_times[3], 6) + 0.0,
+                        'metric_pairs': crater_metrics.npairs - start_pairs}
+            previous = [s for s in self.stages if s['name'] == self.current]
+            if previous:
+                for key in measured:
+                    previous[0][key] += measured[key]
+                previous[0]['peak_rss_mb'] = max(previous[0]['peak_rss_mb'], peak_rss() / 1024.0**2)
+            else:
+                measured.update(name=self.current, peak_rss_mb=peak_rss() / 1024.0**2,
+                                peak_rss_reset=self.peak_reset)
+                self.stages.append(measured)
+        self.current = name
+        if name is not None:
+            self.peak_reset = reset_peak_rss()
+            self.start = time.time(), os.times(), crater_metrics.npairs
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def summary(self):
+        return '\n'.join('%-10s %10.3f s wall %10.3f s cpu %10.1f MB peak %12i pairs'%(
+            s['name'], s['wall'], s['cpu'], s['peak_rss_mb'], s['metric_pairs']) for s in self.stages)
+
+    def write(self, filename, **info):
+        # json of the stages and counts, with any other information given
+        info.update(stages=self.stages, counts=self.counts)
+        with open(filename, 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+
+
+def count_event(name, n=1):
+    # add to a count of the StageReport of the mz_cluster run in progress, if any
+    if _report is not None:
+        _report.count(name, n)
+
+
+def reset_peak_rss():
+    # reset the peak resident set size reported in /proc/self/status, if possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    # peak resident set size of this process, in bytes
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kilobytes on Linux, bytes on Mac OS X
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def size_histogram(sizes):
+    # number of clusters of each size present, as a dict for json
+    counts = numpy.bincount(sizes)
+    present = numpy.flatnonzero(counts)
+    return dict((str(size), int(counts[size])) for size in present)
+
+
+def submit_plot(background, function, *args, **kwargs):
+    # Make a plot now, or in the pool of plotting processes if background,
+    # which is started when first needed and receives copies of the arrays
+    global _plot_pool
+    if not background:
+        return function(*args, **kwargs)
+    if _plot_pool is None:
+        _plot_pool = Pool(plot_nprocs)
+    _plot_jobs.append(_plot_pool.apply_async(function, args, kwargs))
+
+
+def wait_for_plots():
+    # Wait for all background plots to be finished, raising any of their errors
+    global _plot_pool
+    if _plot_pool is None:
+        return
+    pool, jobs = _plot_pool, _plot_jobs[:]
+    _plot_pool = None
+    del _plot_jobs[:]
+    pool.close()
+    try:
+        for job in jobs:
+            job.get()
+    finally:
+        pool.join()
+
+atexit.register(wait_for_plots)
+
+
 def plot_cluster_stats(dra, drs, ds, s, notminsize, output_filename_base):
     x = numpy.arange(0.0, s.max(), 0.1)
     minsize = numpy.logical_not(notminsize)
@@ -552,36 +1542,72 @@ def plot_cluster_stats(dra, drs, ds, s, notminsize, output_filename_base):
     pyplot.close()
 
     
-def plot_crater_stats(crater_mean, truth, output_filename_base):
-    plot_crater_sizefreq(crater_mean, truth, output_filename_base)
-    plot_crater_cumsizefreq(crater_mean, truth, output_filename_base)
+def plot_crater_stats(crater_mean, truth, output_filename_base, stats=None):
+    if truth is not None and stats is None:
+        stats = sizefreq_stats(crater_mean, truth)
+    plot_crater_sizefreq(crater_mean, truth, output_filename_base, stats)
+    plot_crater_cumsizefreq(crater_mean, truth, output_filename_base, stats)
+    return stats
+
+
+sizefreq_stat_names = ('KS_D', 'KS_p', 'mean_delta', 'med_delta', 'rms_delta', 'mad_delta',
+                       'cum_mean_delta', 'cum_med_delta', 'cum_rms_delta', 'cum_mad_delta')
+
+
+def sizefreq_stats(crater_mean, truth):
+    """Compare the size-frequency distributions of clustered and truth craters.
+
+    Returns a dict of the statistics named in sizefreq_stat_names: the
+    two sample KS test of the radii, and the mean, median, rms and median
+    absolute values of the differences between the differential (in units
+    of the Poisson error) and cumulative (fractional) distributions.
+
+    """
+    stats = {}
+    stats['KS_D'], stats['KS_p'] = ks_2samp(crater_mean['radius'], truth['radius'])
+    sf_bins_clust, sf_clust = sizefreq(2*crater_mean['radius'])
+    sf_bins_truth, sf_truth = sizefreq(2*truth['radius'], sf_bins_clust)
+    ok = (sf_clust > 0) & (sf_truth > 0)
+    #delta = (sf_clust[ok].astype(numpy.float) - sf_truth[ok])/sf_truth[ok]
+    delta = (sf_clust[ok].astype(numpy.float) - sf_truth[ok])/numpy.sqrt(sf_truth[ok])
+    stats.update(delta_stats(delta))
+    sf_bins_clust, sf_clust = cumsizefreq(2*crater_mean['radius'])
+    sf_bins_truth, sf_truth = cumsizefreq(2*truth['radius'], sf_bins_clust)
+    ok = (sf_clust > 0) & (sf_truth > 0)
+    delta = sf_clust[ok].astype(numpy.float)/sf_truth[ok] - 1
+    stats.update(delta_stats(delta, 'cum_'))
+    return stats
+
+
+def print_sizefreq_stats(stats):
+    print
+    print('KS D, p = %.3f, %.3f'%(stats['KS_D'], stats['KS_p']))
+    for name in ('mean_delta', 'med_delta', 'rms_delta', 'mad_delta'):
+        print('%s = %.3f'%(name, stats[name]))
+    print
+    for name in ('mean_delta', 'med_delta', 'rms_delta', 'mad_delta'):
+        print('cum_%s = %.3f'%(name, stats['cum_'+name]))
+
 
+def delta_stats(delta, prefix=''):
+    return {prefix+'mean_delta': delta.mean(),
+            prefix+'med_delta': numpy.median(delta),
+            prefix+'rms_delta': numpy.sqrt((delta**2).mean()),
+            prefix+'mad_delta': numpy.median(numpy.abs(delta))}
 
-def plot_crater_sizefreq(crater_mean, truth, output_filename_base):
+
+def plot_crater_sizefreq(crater_mean, truth, output_filename_base, stats=None):
     pyplot.figure(figsize=(6., 8.))
     sf_bins_clust, sf_clust = plot_sizefreq(2*crater_mean['radius'], label='clustered')
     if truth is not None:
-        print
         sf_bins_truth, sf_truth = plot_sizefreq(2*truth['radius'], sf_bins_clust, label='truth')
-        ok = (sf_clust > 0) & (sf_truth > 0)
-        D, p = ks_2samp(crater_mean['radius'], truth['radius'])
-        text = 'KS D, p = %.3f, %.3f'%(D, p)
+        if stats is None:
+            stats = sizefreq_stats(crater_mean, truth)
+        text = 'KS D, p = %.3f, %.3f'%(stats['KS_D'], stats['KS_p'])
         pyplot.text(1.75, 100.0, text)
-        print text
-        #delta = (sf_clust[ok].astype(numpy.float) - sf_truth[ok])/sf_truth[ok]
-        delta = (sf_clust[ok].astype(numpy.float) - sf_truth[ok])/numpy.sqrt(sf_truth[ok])
-        text = 'mean_delta = %.3f'%delta.mean()
-        print text
-        pyplot.text(1.75, 95, text)
-        text = 'med_delta = %.3f'%numpy.median(delta)
-        print text
-        pyplot.text(1.75, 90, text)
-        text = 'rms_delta = %.3f'%numpy.sqrt((delta**2).mean())
-        print text    
-        pyplot.text(1.75, 85, text)
-        text = 'mad_delta = %.3f'%numpy.median(numpy.abs(delta))
-        print text
-        pyplot.text(1.75, 80, text)
+        for y, name in zip((95, 90, 85, 80), ('mean_delta', 'med_delta', 'rms_delta', 'mad_delta')):
+            text = '%s = %.3f'%(name, stats[name])
+            pyplot.text(1.75, y, text)
     pyplot.axis(xmin=0.8, xmax=3.0, ymin=0.0)
     pyplot.xlabel('log10(diameter [m])')
     pyplot.ylabel('frequency')
@@ -590,35 +1616,30 @@ def plot_crater_sizefreq(crater_mean, truth, output_filename_base):
     pyplot.close()
 
 
-def plot_sizefreq(size, bins=10, label=''):
+def sizefreq(size, bins=10):
     h, b = numpy.histogram(numpy.log10(size), bins, range=(0.8, 3.0))
+    return b, h
+
+
+def plot_sizefreq(size, bins=10, label=''):
+    b, h = sizefreq(size, bins)
     c = 0.5*(b[:-1]+b[1:])
     err = numpy.sqrt(h)
     ax = pyplot.errorbar(c, h, yerr=err, ls='steps-mid', label=label)
     return b, h
 
 
-def plot_crater_cumsizefreq(crater_mean, truth, output_filename_base):
+def plot_crater_cumsizefreq(crater_mean, truth, output_filename_base, stats=None):
     pyplot.figure(figsize=(6., 8.))
     pyplot.plot([0.8, 3.0], [10**3.5, 0.5], ':k')
     sf_bins_clust, sf_clust = plot_cumsizefreq(2*crater_mean['radius'], label='clustered')
     if truth is not None:
-        print
         sf_bins_truth, sf_truth = plot_cumsizefreq(2*truth['radius'], sf_bins_clust, label='truth')
-        ok = (sf_clust > 0) & (sf_truth > 0)
-        delta = sf_clust[ok].astype(numpy.float)/sf_truth[ok] - 1
-        text = 'cum_mean_delta = %.3f'%delta.mean()
-        print text
-        pyplot.text(1.0, 10**1.0, text)
-        text = 'cum_med_delta = %.3f'%numpy.median(delta)
-        print text
-        pyplot.text(1.0, 10**0.8, text)
-        text = 'cum_rms_delta = %.3f'%numpy.sqrt((delta**2).mean())
-        print text    
-        pyplot.text(1.0, 10**0.6, text)
-        text = 'cum_mad_delta = %.3f'%numpy.median(numpy.abs(delta))
-        print text
-        pyplot.text(1.0, 10**0.4, text)
+        if stats is None:
+            stats = sizefreq_stats(crater_mean, truth)
+        for y, name in zip((1.0, 0.8, 0.6, 0.4), ('mean_delta', 'med_delta', 'rms_delta', 'mad_delta')):
+            text = 'cum_%s = %.3f'%(name, stats['cum_'+name])
+            pyplot.text(1.0, 10**y, text)
     pyplot.axis(xmin=0.8, xmax=3.0, ymin=0.5, ymax=10**3.5)
     pyplot.xlabel('log10(diameter [m])')
     pyplot.ylabel('cumulative frequency')
@@ -627,59 +1648,208 @@ def plot_crater_cumsizefreq(crater_mean, truth, output_filename_base):
     pyplot.close()
 
 
-def plot_cumsizefreq(size, bins=10000, label=''):
+def cumsizefreq(size, bins=10000):
     h, b = numpy.histogram(numpy.log10(size), bins)
     c = numpy.cumsum(h[::-1])
     c = c[::-1]
     c = numpy.concatenate((c[0:1], c))
+    return b, c
+
+
+def plot_cumsizefreq(size, bins=10000, label=''):
+    b, c = cumsizefreq(size, bins)
     ax = pyplot.plot(b, c, ls='steps-pre', label=label)
     pyplot.gca().set_yscale('log')
     return b, c
 
 
 def get_coverage(nac_names, point=None, db='moonzoo'):
-    db = pymysql.connect(host="localhost", user="root", passwd="", db=db)
-    cur = db.cursor() 
-    nac_names = '("'+'","'.join(nac_names)+'")'
+    """Number of views of the given NACs, in each of the three zoom bands.
+
+    Returns rasters, extent -- the summed nviews of the slices covering
+    each pixel, as an array of shape (3, nlat, nlong), and the (long_min,
+    long_max, lat_min, lat_max) of the rasters.  If a (long, lat) point
+    is given, returns just the three numbers of views at that point.
+    The zoom bands are zoom > 6, 2 to 6 and < 2.
+
+    The rasters for each NAC are made once and cached, in coverage_cache,
+    and in memory, so after the first call for a NAC in a process, point
+    lookups and plots need no database queries.
+
+    """
+    rasters = [coverage_raster(nac_name, db) for nac_name in nac_names]
+    rasters = [r for r in rasters if r[0].size > 0]
     if point is not None:
-        point = 'and %f between long_min and long_max and %f between lat_min and lat_max'%point
+        nviews = numpy.zeros(3, numpy.int)
+        j = int(numpy.floor(point[0] / coverage_resolution))
+        i = int(numpy.floor(point[1] / coverage_resolution))
+        for raster, i0, j0 in rasters:
+            if 0 <= i - i0 < raster.shape[1] and 0 <= j - j0 < raster.shape[2]:
+                nviews += raster[:, i - i0, j - j0]
+        return nviews
+    if len(rasters) == 0:
+        return numpy.zeros((3, 0, 0), numpy.int32), (0.0, 0.0, 0.0, 0.0)
+    # add the rasters of all NACs, which share the same grid, into one
+    imin = min(i0 for raster, i0, j0 in rasters)
+    jmin = min(j0 for raster, i0, j0 in rasters)
+    imax = max(i0 + raster.shape[1] for raster, i0, j0 in rasters)
+    jmax = max(j0 + raster.shape[2] for raster, i0, j0 in rasters)
+    total = numpy.zeros((3, imax - imin, jmax - jmin), numpy.int32)
+    for raster, i0, j0 in rasters:
+        total[:, i0-imin:i0-imin+raster.shape[1], j0-jmin:j0-jmin+raster.shape[2]] += raster
+    extent = tuple(numpy.array([jmin, jmax, imin, imax]) * coverage_resolution)
+    return total, extent
+
+
+def coverage_raster(nac_name, db='moonzoo'):
+    # nviews rasters for one NAC, with the indices of their first pixel in the
+    # global grid of coverage_resolution, from memory, disk or the database
+    key = (db, nac_name)
+    if key in _coverage:
+        return _coverage[key]
+    cur = get_db(db).cursor()
+    cur.execute("CHECKSUM TABLE slice_counts")
+    checksum = int(cur.fetchone()[1])
+    filename = os.path.join(coverage_cache, '%s_%s.npz'%(db, nac_name))
+    cached = None
+    if os.path.exists(filename):
+        cached = numpy.load(filename)
+        if int(cached['checksum']) != checksum or cached['resolution'] != coverage_resolution:
+            cached = None
+    if cached is not None:
+        raster, i0, j0 = cached['raster'], int(cached['i0']), int(cached['j0'])
     else:
-        point = ''
-    data = []
-    for zoom in ("> 6", "between 2 and 6", "< 2"):
-        sql = "SELECT nviews, zoom, long_min, long_max, lat_min, lat_max FROM slice_counts WHERE nac_name in %s and zoom %s %s;"%(nac_names, zoom, point)
-        cur.execute(sql)
-        names = [d[0] for d in cur.description]
-        data.append(numpy.rec.fromrecords(cur.fetchall(), names=names))
-    db.close()
-    return data
-
-
-def plot_image(img, ax, extent):
+        cur.execute("""SELECT nviews, zoom, long_min, long_max, lat_min, lat_max
+                       FROM slice_counts WHERE nac_name = %s""", (nac_name,))
+        slices = numpy.array(cur.fetchall(), numpy.float).reshape(-1, 6)
+        raster, i0, j0 = make_coverage_raster(*slices.T)
+        if not os.path.isdir(coverage_cache):
+            os.makedirs(coverage_cache)
+        tmp = filename + '.%i.tmp.npz'%os.getpid()
+        numpy.savez(tmp, checksum=checksum, resolution=coverage_resolution, raster=raster, i0=i0, j0=j0)
+        os.rename(tmp, filename)
+    cur.close()
+    _coverage[key] = (raster, i0, j0)
+    return _coverage[key]
+
+
+def make_coverage_raster(nviews, zoom, long_min, long_max, lat_min, lat_max):
+    # Sum the nviews of each slice into every pixel whose centre it covers,
+    # by adding the slice corners to a difference array and summing it
+    if len(nviews) == 0:
+        return numpy.zeros((3, 0, 0), numpy.int32), 0, 0
+    j1 = numpy.ceil(long_min / coverage_resolution - 0.5).astype(numpy.int)
+    j2 = numpy.ceil(long_max / coverage_resolution - 0.5).astype(numpy.int)
+    i1 = numpy.ceil(lat_min / coverage_resolution - 0.5).astype(numpy.int)
+    i2 = numpy.ceil(lat_max / coverage_resolution - 0.5).astype(numpy.int)
+    i0, j0 = i1.min(), j1.min()
+    i1, i2, j1, j2 = i1 - i0, i2 - i0, j1 - j0, j2 - j0
+    shape = (3, i2.max() + 1, j2.max() + 1)
+    diff = numpy.zeros(shape, numpy.int32)
+    bands = numpy.where(zoom > 6, 0, numpy.where(zoom >= 2, 1, 2))
+    for k in range(3):
+        band = bands == k
+        n = nviews[band].astype(numpy.int32)
+        for i, j, sign in ((i1, j1, 1), (i1, j2, -1), (i2, j1, -1), (i2, j2, 1)):
+            numpy.add.at(diff[k], (i[band], j[band]), sign * n)
+    raster = diff.cumsum(axis=1).cumsum(axis=2)[:, :-1, :-1]
+    return raster.astype(numpy.int32), i0, j0
+
+
+def coverage_colours(raster, alpha=0.1):
+    # red for up to two views, blue for three or four and green for five or
+    # more, more opaque with more views, as an RGBA image
+    rgba = numpy.zeros(raster.shape + (4,), numpy.float)
+    rgba[..., 0] = (raster > 0) & (raster <= 2)
+    rgba[..., 2] = (raster > 2) & (raster < 5)
+    rgba[..., 1] = raster >= 5
+    rgba[..., 3] = numpy.minimum(alpha*raster, 1.0)
+    return rgba
+
+
+def plot_image(img, ax, extent, dpi=300):
+    # Show the smallest level of the image pyramid that still has at least
+    # as many pixels as the axes will have when saved at the given dpi
     if img is not None and img.lower() != 'none':
-        import Image
-        img = Image.open(img)
-        a = numpy.asarray(img)
+        fig = ax.get_figure()
+        position = ax.get_position()
+        width = position.width * fig.get_figwidth() * dpi
+        height = position.height * fig.get_figheight() * dpi
+        levels = image_pyramid(img)
+        a = levels[0]
+        for level in levels[1:]:
+            if level.shape[1] < width or level.shape[0] < height:
+                break
+            a = level
         ax.imshow(a, cmap='gray', extent=extent)
 
 
+def image_pyramid(img):
+    """Levels of an image, each half the size of the one before.
+
+    The levels are cached in image_cache as memory mapped .npy files,
+    which are made again if the image file changes.  The smallest level
+    is at least min_pyramid_size pixels on its shorter side.
+
+    """
+    path = os.path.join(image_cache, os.path.basename(img) + '.pyramid')
+    stat = os.stat(img)
+    source = numpy.array([stat.st_mtime, stat.st_size])
+    sourcefile = os.path.join(path, 'source.npy')
+    if not (os.path.exists(sourcefile) and (numpy.load(sourcefile) == source).all()):
+        # build in a temporary directory, as other plotting processes may
+        # be reading the old levels or building the same pyramid
+        tmp = path + '.%i.tmp'%os.getpid()
+        build_image_pyramid(img, tmp)
+        numpy.save(os.path.join(tmp, 'source.npy'), source)
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp)
+    levels = []
+    k = 0
+    while os.path.exists(os.path.join(path, 'level%i.npy'%k)):
+        levels.append(numpy.load(os.path.join(path, 'level%i.npy'%k), mmap_mode='r'))
+        k += 1
+    return levels
+
+
+def build_image_pyramid(img, path, rows=256):
+    try:
+        import Image
+    except ImportError:
+        from PIL import Image
+    os.makedirs(path)
+    # the image is only decoded once, and each level is made from the one
+    # before, a block of rows at a time
+    a = numpy.asarray(Image.open(img))
+    level = numpy.lib.format.open_memmap(os.path.join(path, 'level0.npy'), 'w+', a.dtype, a.shape)
+    level[:] = a
+    del a
+    k = 0
+    while min(level.shape[:2]) >= 2*min_pyramid_size:
+        k += 1
+        shape = (level.shape[0]//2, level.shape[1]//2) + level.shape[2:]
+        smaller = numpy.lib.format.open_memmap(os.path.join(path, 'level%i.npy'%k), 'w+', level.dtype, shape)
+        for i in range(0, shape[0], rows):
+            j = min(i + rows, shape[0])
+            block = level[2*i:2*j, :2*shape[1]].astype(numpy.float)
+            block = block.reshape((j-i, 2, shape[1], 2) + shape[2:]).mean(axis=(1, 3))
+            smaller[i:j] = block.round().astype(level.dtype)
+        smaller.flush()
+        level = smaller
+
+
 def plot_coverage(long_min, long_max, lat_min, lat_max, output_filename_base, 
                   nac_names=['M104311715RE'], img='../New_CC/ROI_715.png'):
-    alpha = 0.1
-    data = get_coverage(nac_names)
+    rasters, extent = get_coverage(nac_names)
     fig, ax = pyplot.subplots(3, sharex=True, sharey=True)
-    for i, datazoom in enumerate(data):
+    for i, raster in enumerate(rasters):
         plot_image(img, ax[i], (long_min, long_max, lat_min, lat_max))
-        for nviews, zoom, long1, long2, lat1, lat2 in datazoom:
-            if not (long2 < long_min or long1 > long_max or lat2 < lat_min or lat1 > lat_max):
-                if nviews <= 2:
-                    c = 'r'
-                elif nviews >= 5:
-                    c = 'g'
-                else:
-                    c = 'b'
-                a = min(alpha*nviews, 1.0)
-                ax[i].add_patch(pyplot.Rectangle((long1, lat1), long2-long1, lat2-lat1, facecolor=c, edgecolor='none', linewidth=0, alpha=a))
+        if raster.size > 0:
+            ax[i].imshow(coverage_colours(raster), extent=extent, origin='lower', interpolation='nearest')
     y_formatter = matplotlib.ticker.ScalarFormatter(useOffset=False)
     fig.subplots_adjust(hspace=0.05)
     for a in ax:
@@ -782,6 +1952,79 @@ def timetest():
     t = timethis('mz_cluster()', globals(), repeat=3, number=1)
     print('Time: %f s'%t)
 
+
+def treetest(ncraters=100, nobs=10, threshold=1.0):
+    from timethis import timethis
+    from sklearn import metrics
+    make_test_craters(ncraters, nobs)
+    points = numpy.recfromtxt('testcraters.csv', delimiter=',', names=True)
+    p = numpy.array([points[name] for name in ('long', 'lat', 'radius', 'minsize')], numpy.double)
+    p[0:2] *= pi/180.0
+    X = p.T
+    c1 = fastclusterdata(X, t=threshold, criterion='distance', method='single')
+    c2 = treeclusterdata(X, t=threshold)
+    if c1.max() == c2.max() and metrics.adjusted_rand_score(c1, c2) == 1.0:
+        print('tree clusters match')
+    else:
+        print('tree clusters do not match')
+        return c1, c2
+    t1 = timethis('treeclusterdata(X, t=threshold)', globals(), locals())
+    t2 = timethis('fastclusterdata(X, t=threshold)', globals(), locals())
+    f = t1/t2
+    print('Tree clustering runs in a factor of %.3f of the time of fastcluster'%f)
+
+
+def dbscantest(ncraters=100, nobs=10, threshold=1.0, mincount=2):
+    from timethis import timethis
+    from sklearn import metrics
+    make_test_craters(ncraters, nobs)
+    points = numpy.recfromtxt('testcraters.csv', delimiter=',', names=True)
+    p = numpy.array([points[name] for name in ('long', 'lat', 'radius', 'minsize')], numpy.double)
+    p[0:2] *= pi/180.0
+    X = p.T
+    c1 = fastclusterdata(X, t=threshold, criterion='distance', method='single')
+    c2 = dbscanclusterdata(X, threshold, mincount)
+    print('Adjusted Rand Index of dbscan and fastcluster clusters: %.3f'%metrics.adjusted_rand_score(c1, c2))
+    t1 = timethis('dbscanclusterdata(X, threshold, mincount)', globals(), locals())
+    t2 = timethis('fastclusterdata(X, t=threshold)', globals(), locals())
+    f = t1/t2
+    print('DBSCAN clustering runs in a factor of %.3f of the time of fastcluster'%f)
+
+
+def updatetest(ncraters=400, nobs=10, nnew=200):
+    # mz_cluster_update of nnew markings, from a marking store without the
+    # truelabel column of the csv file, should find the same craters as
+    # clustering all the markings again, and of none change nothing
+    from mz_catalogue import read_crater_cat
+    from mz_markings import write_marking_store
+    make_test_craters(ncraters, nobs, seed=1)
+    lines = open('testcraters.csv').readlines()
+    n = len(lines) - 1 - nnew
+    for filename, rows in (('updatetest_old.csv', lines[1:n+1]), ('updatetest_new.csv', lines[n+1:]),
+                           ('updatetest_empty.csv', [])):
+        with open(filename, 'w') as f:
+            f.writelines([lines[0]] + rows)
+    args = ('none', 'none', 'none', 1.0, 2, 10, 3, 0.2, 0.2, 100)
+    mz_cluster('updatetest_all', 'testcraters.csv', *args, plots='none')
+    mz_cluster('updatetest', 'updatetest_old.csv', *args, plots='none', save_state=True)
+    files = ('updatetest_craters.csv', 'updatetest_state.npz')
+    before = [open(f, 'rb').read() for f in files]
+    mz_cluster_update('updatetest', 'updatetest_empty.csv')
+    if [open(f, 'rb').read() for f in files] == before:
+        print('empty update leaves state and catalogue unchanged')
+    else:
+        print('empty update changes state or catalogue')
+    write_marking_store('updatetest_new', read_markings('updatetest_new.csv'))
+    mz_cluster_update('updatetest', 'updatetest_new')
+    # changed clusters are listed last, so compare the catalogues in the same order
+    cats = [read_crater_cat(f) for f in ('updatetest_craters.csv', 'updatetest_all_craters.csv')]
+    cats = [cat[numpy.lexsort((cat['radius'], cat['lat'], cat['long']))] for cat in cats]
+    if len(cats[0]) == len(cats[1]) and all(numpy.allclose(cats[0][name], cats[1][name], atol=1e-6)
+                                            for name in cats[0].dtype.names):
+        print('updated craters match')
+    else:
+        print('updated craters do not match')
+
     
 class Usage(Exception):
     def __init__(self, msg):
@@ -793,10 +2036,14 @@ def main(argv=None):
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hf", ["help", "force"])
+            opts, args = getopt.getopt(argv[1:], "hfcbsup", ["help", "force", "catalogue-only", "binary",
+                                                            "save-state", "update", "profile"])
         except getopt.error, msg:
             raise Usage(msg)
         clobber = False
+        plots = 'background'
+        catalogue_format = 'csv'
+        save_state = update = profile = False
         for o, a in opts:
             if o in ("-h", "--help"):
                 print('\n'+__doc__)
@@ -804,14 +2051,31 @@ def main(argv=None):
                 return 1
             if o in ("-f", "--force"):
                 clobber = True
+            if o in ("-c", "--catalogue-only"):
+                plots = 'none'
+            if o in ("-b", "--binary"):
+                catalogue_format = 'npy'
+            if o in ("-s", "--save-state"):
+                save_state = True
+            if o in ("-u", "--update"):
+                update = True
+            if o in ("-p", "--profile"):
+                profile = True
+        if update:
+            if len(args) != 2:
+                raise Usage("Update requires an output_filename_base and a new markings csv file")
+            mz_cluster_update(args[0], args[1], catalogue_format)
+            return 0
         for i in range(len(args)):
             if i > 4:
                 args[i] = float(args[i])
         if len(args) > 0:
-            output = args[0]+'_craters.csv'
+            output = crater_cat_filename(args[0], catalogue_format)
             if os.path.exists(output) and (not clobber):
                 raise Usage("Output file already exists: %s\nUse -f to overwrite."%output)
-            mz_cluster(*args)
+            mz_cluster(*args, plots=plots, catalogue_format=catalogue_format, save_state=save_state,
+                       profile=profile)
+            wait_for_plots()
         else:
             timetest()
     except Usage, err:
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+"""mz_markings.py - Convert a markings csv file to a binary column store.
+
+    Version 2014-03-24
+
+    Usage:
+        mz_markings.py <markings_csv> <markings_store>
+
+    Usage example:
+        python mz_markings.py markings/M104311715RE.csv markings/M104311715RE
+
+    The store is a directory holding one .npy file for each of the columns
+    long, lat, radius, axialratio, angle, boulderyness, minsize and user,
+    as written by pix2latlong.py when its output name does not end in
+    '.csv'.  mz_cluster.py accepts a store wherever it accepts a markings
+    csv file.  The columns are memory mapped, so only those requested,
+    and only the rows within the region of interest, are ever read.
+
+"""
+
+import os, sys, getopt
+import numpy
+from numpy.lib.format import open_memmap
+
+marking_columns = (('long', numpy.double), ('lat', numpy.double), ('radius', numpy.double),
+                   ('axialratio', numpy.double), ('angle', numpy.double),
+                   ('boulderyness', numpy.int32), ('minsize', numpy.int8), ('user', numpy.int64))
+
+marking_names = tuple(name for name, dtype in marking_columns)
+
+
+def is_marking_store(path):
+    return os.path.isdir(path)
+
+
+def write_marking_store(path, columns):
+    # columns may be a record array or a sequence of arrays in marking_names order
+    if hasattr(columns, 'dtype') and columns.dtype.names is not None:
+        columns = [columns[name] for name in marking_names]
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for (name, dtype), column in zip(marking_columns, columns):
+        numpy.save(os.path.join(path, name+'.npy'), numpy.asarray(column, dtype))
+
+
+def create_marking_store(path, n, columns=marking_columns):
+    # memory mapped columns of n markings, to be filled in place
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return dict((name, open_memmap(os.path.join(path, name+'.npy'), 'w+', dtype, (n,)))
+                for name, dtype in columns)
+
+
+def open_marking_store(path, names=marking_names):
+    # memory mapped columns, which are only read as they are used
+    return dict((name, numpy.load(os.path.join(path, name+'.npy'), mmap_mode='r')) for name in names)
+
+
+def read_marking_columns(path, names=marking_names, region=None):
+    """Read the named columns of a marking store into a dict of arrays.
+
+    If region = (long_min, long_max, lat_min, lat_max) is given, only the
+    long and lat columns are read in full, and only the markings inside
+    the region are read from the others.
+
+    """
+    columns = open_marking_store(path, names)
+    if region is None:
+        return dict((name, numpy.array(columns[name])) for name in names)
+    long_min, long_max, lat_min, lat_max = region
+    position = open_marking_store(path, ('long', 'lat'))
+    select = (position['long'] >= long_min) & (position['long'] <= long_max)
+    select &= (position['lat'] >= lat_min) & (position['lat'] <= lat_max)
+    select = numpy.flatnonzero(select)
+    return dict((name, columns[name][select]) for name in names)
+
+
+def read_marking_store(path, names=marking_names, region=None):
+    # the columns of read_marking_columns as a record array
+    columns = read_marking_columns(path, names, region)
+    return numpy.rec.fromarrays([columns[name] for name in names], names=names)
+
+
+def read_markings(moonzoo_markings_csv, region=None):
+    if is_marking_store(moonzoo_markings_csv):
+        return read_marking_store(moonzoo_markings_csv, region=region)
+    points = numpy.recfromtxt(moonzoo_markings_csv, delimiter=',', names=True)
+    if points.dtype.names[:3] != ('long', 'lat', 'radius'):
+        # this is a cat from Rob, rather than one produced from the pipeline
+        points.dtype.names = ('long', 'lat', 'radius') + points.dtype.names[3:]
+        n = len(points)
+        points = numpy.rec.fromarrays([points['long'], points['lat'], points['radius'],
+                                       numpy.ones(n, numpy.float), numpy.zeros(n, numpy.float),
+                                       numpy.zeros(n, numpy.float), numpy.zeros(n, numpy.bool),
+                                       numpy.zeros(n, numpy.int)],
+                                       names=marking_names)
+    return points
+
+
+def csv2store(markings_csv, markings_store):
+    write_marking_store(markings_store, read_markings(markings_csv))
+
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hf", ["help", "force"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        clobber = False
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                print __doc__
+                return 1
+            if o in ("-f", "--force"):
+                clobber = True
+        if len(args) != 2:
+            raise Usage("Requires a markings csv filename and an output store name.")
+        if os.path.exists(args[1]) and (not clobber):
+            raise Usage("Output store already exists: %s\nUse -f to overwrite."%args[1])
+        csv2store(*args)
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "For help use --help"
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+"""mz_sweep.py - Run the mz_cluster clustering over a grid of parameters.
+
+    Version 2014-03-20
+
+    Usage:
+        mz_sweep.py <output_table> <markings_csv_pattern> <nac_names> <truth_csv_pattern> <truth_names>
+                    <thresholds> <mincounts> <position_scales> <size_scales>
+                    <maxcount> <maxiter> <min_user_weight> <long_min> <long_max> <lat_min> <lat_max>
+
+    The csv patterns are formatted with each NAC name and truth name, and
+    all other list arguments are comma separated.
+
+    Usage example:
+        python mz_sweep.py test_clustering_results markings/{}.csv M101949648RE,M104311715RE
+               from_rob_2014-01-28/{}.csv Xpert_648,Xpert_715 0.5,0.75,1.0,1.25,1.5 1,2,3,4
+               4.0 0.4 10 3 100 30.699 30.880 20.200 20.275
+
+    Markings and truth catalogues are read once for each NAC, and the
+    single linkage tree of the markings is found once for each
+    (position_scale, size_scale) at the largest threshold.  Each grid point
+    then only cuts that tree, splits large clusters and calculates the
+    size-frequency statistics, in a pool of worker processes.
+
+"""
+
+import os, sys, getopt
+from itertools import product
+from multiprocessing import Pool, cpu_count
+import numpy
+# mz_cluster sets up pyximport, so must be imported before crater_metrics
+from mz_cluster import (read_truth, load_markings, select_markings, select_truth, select_craters,
+                        aggregate_clusters, iterative_fastclusterdata, linkclusterdata, sizefreq_stats,
+                        sizefreq_stat_names, compare, Usage)
+import crater_metrics
+
+# Inputs and single linkage trees shared with the worker processes,
+# which inherit them when the pool is forked
+_markings = {}
+_truths = {}
+_edges = {}
+
+
+def sweep(nacs, truths, thresholds, mincounts, position_scales=(0.2,), size_scales=(0.2,),
+          maxcount=10, maxiter=3, min_user_weight=100, long_min=-1.0, long_max=361.0,
+          lat_min=-91.0, lat_max=91.0, markings_csv='markings/{}.csv',
+          truth_csv='from_rob_2014-01-28/{}.csv', engine='tree', nprocs=None):
+    """Cluster the markings of each NAC for every combination of parameters.
+
+    Every truth catalogue is compared with the craters found from every
+    NAC.  Returns a record array with one row per grid point, giving nac,
+    truth, threshold, mincount, position_scale, size_scale, the number of
+    craters, the median metric distance to the nearest truth crater and
+    the size-frequency statistics in sizefreq_stat_names.
+
+    Keyword arguments:
+    markings_csv, truth_csv -- file names, formatted with the NAC or truth name
+    engine -- clustering engine, as for mz_cluster
+    nprocs -- number of worker processes, default all cores
+    other arguments are as for mz_cluster, but given as sequences
+
+    """
+    if nprocs is None:
+        nprocs = cpu_count()
+    for nac in nacs:
+        points = load_markings(markings_csv.format(nac), (long_min, long_max, lat_min, lat_max))
+        points, user_weights = select_markings(points, long_min, long_max, lat_min, lat_max, min_user_weight)
+        _markings[nac] = (points, user_weights, points.X.T)
+    for tf in truths:
+        truth = read_truth(truth_csv.format(tf))
+        _truths[tf] = (truth, truth['radius'].min())
+    tmax = max(thresholds)
+    for nac, pscale, sscale in product(nacs, position_scales, size_scales):
+        print('Linking %s markings for position_scale = %f, size_scale = %f'%(nac, pscale, sscale))
+        crater_metrics.pscale = pscale
+        crater_metrics.sscale = sscale
+        p = _markings[nac][2]
+        T, _edges[(nac, pscale, sscale)] = linkclusterdata(p.T, tmax, engine, nprocs)
+    grid = list(product(nacs, truths, thresholds, mincounts, position_scales, size_scales))
+    args = [g + (maxcount, maxiter, long_min, long_max, lat_min, lat_max) for g in grid]
+    pool = Pool(nprocs)
+    results = pool.map(sweep_point, args)
+    pool.close()
+    pool.join()
+    names = ('nac', 'truth', 'threshold', 'mincount', 'position_scale', 'size_scale',
+             'ncraters', 'match') + sizefreq_stat_names
+    return numpy.rec.fromrecords([g + r for g, r in zip(grid, results)], names=names)
+
+
+def sweep_point((nac, tf, threshold, mincount, pscale, sscale,
+                 maxcount, maxiter, long_min, long_max, lat_min, lat_max)):
+    crater_metrics.pscale = pscale
+    crater_metrics.sscale = sscale
+    points, user_weights, p = _markings[nac]
+    truth, smallest_expert_radius = _truths[tf]
+    # the output of the clustering would be interleaved between processes
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        clusters = iterative_fastclusterdata(p, threshold, maxcount, mincount, maxiter,
+                                             edges=_edges[(nac, pscale, sscale)])
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    crater_mean, crater_stdev, crater_count, crater_score, crater_countnotmin = \
+        aggregate_clusters(points, user_weights, clusters, mincount)[:5]
+    crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin = \
+        select_craters(crater_mean, crater_stdev, crater_score, crater_count, crater_countnotmin, mincount)
+    crater_mean = crater_mean[crater_mean['radius'] > smallest_expert_radius]
+    truth = select_truth(truth, long_min, long_max, lat_min, lat_max, points['radius'].min())
+    if len(crater_mean) == 0 or len(truth) == 0:
+        return (len(crater_mean), numpy.nan) + (numpy.nan,)*len(sizefreq_stat_names)
+    stats = sizefreq_stats(crater_mean, truth)
+    return (len(crater_mean), compare(crater_mean, truth)) + tuple(stats[name] for name in sizefreq_stat_names)
+
+
+def write_sweep_table(results, output_filename, order=('nac', 'truth', 'mad_delta')):
+    # A text table like that made by read_test_clustering.py
+    results = numpy.sort(results, order=list(order))
+    names = results.dtype.names
+    with file(output_filename, 'w') as fout:
+        fout.write(('%16s '*2 + '%14s '*(len(names)-2))%names + '\n')
+        prevname = ''
+        for r in results:
+            if r['nac'] != prevname:
+                fout.write('\n')
+                prevname = r['nac']
+            fout.write(('%16s '*2 + '%14.3f '*(len(names)-2))%tuple(r) + '\n')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hf", ["help", "force"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        clobber = False
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                print('\n'+__doc__)
+                print('More detail on sweep: '+ sweep.__doc__)
+                return 1
+            if o in ("-f", "--force"):
+                clobber = True
+        if len(args) != 16:
+            raise Usage("Wrong number of arguments")
+        output = args[0]
+        if os.path.exists(output) and (not clobber):
+            raise Usage("Output file already exists: %s\nUse -f to overwrite."%output)
+        nacs, truths = args[2].split(','), args[4].split(',')
+        thresholds, mincounts, position_scales, size_scales = \
+            ([float(x) for x in a.split(',')] for a in args[5:9])
+        maxcount, maxiter = int(args[9]), int(args[10])
+        min_user_weight, long_min, long_max, lat_min, lat_max = (float(a) for a in args[11:])
+        results = sweep(nacs, truths, thresholds, mincounts, position_scales, size_scales,
+                        maxcount, maxiter, min_user_weight, long_min, long_max, lat_min, lat_max,
+                        markings_csv=args[1], truth_csv=args[3])
+        write_sweep_table(results, output)
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "For help use --help"
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
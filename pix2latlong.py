@@ -28,6 +28,8 @@
 
     The product is another csv file, containing the longitude, latitude,
     size, axial_ratio, angle, boulderyness, minsize flag and user id for each entry.
+    If output_csv does not end in '.csv', these are instead written as a
+    binary column store, as made by mz_markings.py.
 
     
 """
@@ -38,6 +40,7 @@ from string import strip
 import numpy
 import tempfile
 from multiprocessing import Pool
+from mz_markings import write_marking_store
 
 # Some debugging tools:
 #from IPython import embed
@@ -68,10 +71,6 @@ def read_db(nac_name, db='moonzoo'):
 
 
 def pix2latlong(crater_csv=None, output_csv=None, cub_file=None, nac_name=""):
-    # Open output file for writing
-    out = file(output_csv, 'w')
-    #out.write('x_pix, y_pix, size_pix, lat, long, size_metres\n')
-    out.write('long, lat, radius, axialratio, angle, boulderyness, minsize, user\n')
     # Open input file
     if crater_csv.startswith('db:'):
         db = crater_csv[3:]
@@ -108,6 +107,13 @@ def pix2latlong(crater_csv=None, output_csv=None, cub_file=None, nac_name=""):
     angle %= 180.0
     
     outarray = numpy.rec.fromarrays((long, lat, xradius_metres, axialratio, angle, boulderyness, minsize, user))
+    if not output_csv.endswith('.csv'):
+        # write a binary column store, as mz_markings.py
+        write_marking_store(output_csv, (long, lat, xradius_metres, axialratio, angle, boulderyness, minsize, user))
+        return
+    out = file(output_csv, 'w')
+    #out.write('x_pix, y_pix, size_pix, lat, long, size_metres\n')
+    out.write('long, lat, radius, axialratio, angle, boulderyness, minsize, user\n')
     numpy.savetxt(out, outarray, delimiter=", ", fmt=('%.6f','%.6f','%.3f','%.3f','%.3f','%i','%i','%i'))
     out.close()
 
@@ -1,3 +1,16 @@
-min(timeit.repeat('idx = matchids(a, b)', 'import numpy; a = numpy.random.random_integers(1, 100000, 100000); b = a.copy(); numpy.random.shuffle(b); from matchids_orig import matchids', number=1, repeat=10))
+import timeit
 
-min(timeit.repeat('idx = matchids(a, b)', 'import numpy; a = numpy.random.random_integers(1, 100000, 100000); b = a.copy(); numpy.random.shuffle(b); import pyximport; pyximport.install(); from matchids import matchids', number=1, repeat=10))
+n = 10**7
+setup = 'import numpy; a = numpy.random.random_integers(1, {0}, {0}); b = a.copy(); numpy.random.shuffle(b); b[::10] += {0}; import pyximport; pyximport.install(setup_args={{"include_dirs": numpy.get_include()}}); '.format(n)
+
+# original python version, one searchsorted per id
+print 'matchids_orig', min(timeit.repeat('idx = matchids(a, b)', setup + 'from matchids_orig import matchids', number=1, repeat=1))
+
+# previous cython version, still one searchsorted per id
+print 'matchids_loop', min(timeit.repeat('idx = matchids_loop(a, b)', setup + 'from matchids import matchids_loop', number=1, repeat=3))
+
+# all ids at once, looked up in a table indexed by id
+print 'matchids', min(timeit.repeat('idx = matchids(a, b)', setup + 'from matchids import matchids', number=1, repeat=3))
+
+# ids spread over a much larger range, so they are sorted rather than tabulated
+print 'matchids sparse', min(timeit.repeat('idx = matchids(a*1000, b*1000)', setup + 'from matchids import matchids', number=1, repeat=3))
@@ -1,24 +1,27 @@
 from math import ceil
 
-def timethis(expr, globalvars=None, localvars=None, repeat=5, number=1):
-    t = timethisnow(expr, globalvars, localvars, repeat, number)
+def timethis(expr, globalvars=None, localvars=None, repeat=5, number=1, wall=False):
+    t = timethisnow(expr, globalvars, localvars, repeat, number, wall)
     newnumber = number
     while t < 0.1:
         newnumber *= 10
-        t = timethisnow(expr, globalvars, localvars, repeat, newnumber)
+        t = timethisnow(expr, globalvars, localvars, repeat, newnumber, wall)
     if newnumber != number:
         print 'Using number=%i to ensure minimum of 0.1 sec per repeat'%newnumber
     return t/newnumber
 
 
-def timethisnow(expr, globalvars, localvars, repeat=5, number=1):
+def timethisnow(expr, globalvars, localvars, repeat=5, number=1, wall=False):
+    # wall clock time is needed for multithreaded code, as clock()
+    # adds up the processor time of all the threads
     import time, gc
+    clock = time.time if wall else time.clock
     t = []
     for i in range(repeat):
         gc.disable()
-        start = time.clock()
+        start = clock()
         for j in range(number):
             eval(expr, globalvars, localvars)
-        t.append(time.clock()-start)
+        t.append(clock()-start)
         gc.enable()
     return min(t)